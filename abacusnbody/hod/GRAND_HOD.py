@@ -4,40 +4,72 @@ import time
 from pathlib import Path
 import pkgutil
 import math
-from math import erfc
 
 import numpy as np
 from astropy.table import Table
 from astropy.io import ascii
 
 import numba
-from numba import njit, types, jit
-from numba.typed import Dict
+from numba import njit
+from collections import namedtuple
 
 # import yaml
 # config = yaml.load(open('config/abacus_hod.yaml'))
-# numba.set_num_threads(16)
-float_array = types.float64[:]
-int_array = types.int64[:]
 
-@njit(fastmath=True)
-def n_sat_LRG_modified(M_h, logM_cut, M_cut, M_1, sigma, alpha, kappa): 
+# galaxy arrays of a single tracer, as returned by the central and satellite generators.
+# The id array keeps the integer dtype of the halo ids.
+GalaxyCatalog = namedtuple('GalaxyCatalog', ['x', 'y', 'z', 'vx', 'vy', 'vz', 'mass', 'id'])
+
+# number of halos (or particles) per work unit of the selection kernels, at most 2**16
+# since the kept halos are recorded as uint16 offsets within their block
+BLOCK_SIZE = 16384
+
+@njit(fastmath=True, cache=True)
+def erfc_fast(x):
+    """
+    Polynomial approximation to ``math.erfc`` (Abramowitz & Stegun 7.1.26), absolute error 
+    below 1.5e-7, far below what matters when comparing against uniform randoms. 
+    Saturates to 2 or 0 away from the origin, where the exponential is negligible.
+    """
+    if x <= -6.:
+        return 2.
+    elif x >= 6.:
+        return 0.
+    ax = abs(x)
+    t = 1./(1. + 0.3275911*ax)
+    y = t*(0.254829592 + t*(-0.284496736 + t*(1.421413741 + t*(-1.453152027 + t*1.061405429))))*np.exp(-ax*ax)
+    if x < 0:
+        return 2. - y
+    return y
+
+@njit(fastmath=True, cache=True)
+def erf_fast(x):
+    """
+    Polynomial approximation to ``math.erf``, see ``erfc_fast``.
+    """
+    return 1. - erfc_fast(x)
+
+
+@njit(fastmath=True, cache=True)
+def n_sat_LRG_modified(M_h, logM_h, logM_cut, M_cut, M_1, sigma, alpha, kappa): 
     """
-    Standard Zheng et al. (2005) satellite HOD parametrization for LRGs, modified with n_cent_LRG
+    Standard Zheng et al. (2005) satellite HOD parametrization for LRGs, modified with n_cent_LRG.
+    ``logM_h`` is the precomputed log10 of the halo mass ``M_h``.
     """
     if M_h - kappa*M_cut < 0:
         return 0
-    return ((M_h - kappa*M_cut)/M_1)**alpha*0.5*math.erfc((logM_cut - np.log10(M_h))/(1.41421356*sigma))
+    return ((M_h - kappa*M_cut)/M_1)**alpha*0.5*erfc_fast((logM_cut - logM_h)/(1.41421356*sigma))
 
 
-@njit(fastmath=True)
-def n_cen_LRG(M_h, logM_cut, sigma): 
+@njit(fastmath=True, cache=True)
+def n_cen_LRG(logM_h, logM_cut, sigma): 
     """
-    Standard Zheng et al. (2005) central HOD parametrization for LRGs.
+    Standard Zheng et al. (2005) central HOD parametrization for LRGs, 
+    given the log10 of the halo mass.
     """
-    return 0.5*math.erfc((logM_cut - np.log10(M_h))/(1.41421356*sigma))
+    return 0.5*erfc_fast((logM_cut - logM_h)/(1.41421356*sigma))
 
-@njit(fastmath=True)
+@njit(fastmath=True, cache=True)
 def N_sat_generic(M_h, M_cut, kappa, M_1, alpha, A_s=1.):
     """
     Standard Zheng et al. (2005) satellite HOD parametrization for all tracers with an optional amplitude parameter, A_s.
@@ -46,62 +78,40 @@ def N_sat_generic(M_h, M_cut, kappa, M_1, alpha, A_s=1.):
         return 0
     return A_s*((M_h-kappa*M_cut)/M_1)**alpha
 
-@njit(fastmath=True)
-def N_cen_ELG_v1(M_h, p_max, Q, logM_cut, sigma, gamma):
+@njit(fastmath=True, cache=True)
+def N_cen_ELG_v1(logM_h, p_max, Q, logM_cut, sigma, gamma):
     """
-    HOD function for ELG centrals taken from arXiv:1910.05095.
+    HOD function for ELG centrals taken from arXiv:1910.05095, 
+    given the log10 of the halo mass. The gaussian and the error function step share 
+    the standardized mass offset, which is computed once.
     """
-    logM_h = np.log10(M_h)
-    phi = phi_fun(logM_h, logM_cut, sigma)
-    Phi = Phi_fun(logM_h, logM_cut, sigma, gamma)
-    A = A_fun(p_max, Q, phi, Phi)
-    return 2.*A*phi*Phi + 0.5/Q*(1 + math.erf((logM_h-logM_cut)*100))
-
-@njit(fastmath=True)
-def N_cen_ELG_v2(M_h, p_max, logM_cut, sigma, gamma):
+    x = (logM_h - logM_cut)/sigma
+    phi = 0.3989422804014327/sigma*np.exp(-x**2/2)
+    Phi = 0.5*(1 + erf_fast(gamma*x/1.41421356))
+    A = p_max - 1./Q
+    return 2.*A*phi*Phi + 0.5/Q*(1 + erf_fast((logM_h-logM_cut)*100))
+
+@njit(fastmath=True, cache=True)
+def N_cen_ELG_v2(M_h, logM_h, p_max, logM_cut, sigma, gamma):
     """
     HOD function for ELG centrals taken from arXiv:2007.09012.
+    ``logM_h`` is the precomputed log10 of the halo mass ``M_h``.
     """
-    logM_h = np.log10(M_h)
     if logM_h <= logM_cut:
         return p_max*Gaussian_fun(logM_h, logM_cut, sigma)
     else:
         return p_max*(M_h/10**logM_cut)**gamma/(2.5066283*sigma)
 
-@njit(fastmath=True)
-def N_cen_QSO(M_h, p_max, logM_cut, sigma):
+@njit(fastmath=True, cache=True)
+def N_cen_QSO(logM_h, p_max, logM_cut, sigma):
     """
-    HOD function (Zheng et al. (2005) with p_max) for QSO centrals taken from arXiv:2007.09012.
+    HOD function (Zheng et al. (2005) with p_max) for QSO centrals taken from arXiv:2007.09012,
+    given the log10 of the halo mass.
     """
-    return 0.5*p_max*(1 + math.erf((np.log10(M_h)-logM_cut)/1.41421356/sigma))
-
+    return 0.5*p_max*(1 + erf_fast((logM_h-logM_cut)/1.41421356/sigma))
 
-@njit(fastmath=True)
-def phi_fun(logM_h, logM_cut, sigma):
-    """
-    Aiding function for N_cen_ELG_v1().
-    """
-    phi = Gaussian_fun(logM_h, logM_cut, sigma)
-    return phi
 
-@njit(fastmath=True)
-def Phi_fun(logM_h, logM_cut, sigma, gamma):
-    """
-    Aiding function for N_cen_ELG_v1().
-    """
-    x = gamma*(logM_h-logM_cut)/sigma
-    Phi = 0.5*(1 + math.erf(x/np.sqrt(2)))
-    return Phi
-    
-@njit(fastmath=True)
-def A_fun(p_max, Q, phi, Phi):
-    """
-    Aiding function for N_cen_ELG_v1().
-    """
-    A = (p_max-1./Q)
-    return A
-    
-@njit(fastmath=True)
+@njit(fastmath=True, cache=True)
 def Gaussian_fun(x, mean, sigma):
     """
     Gaussian function with centered at `mean' with standard deviation `sigma'.
@@ -109,7 +119,7 @@ def Gaussian_fun(x, mean, sigma):
     return 0.3989422804014327/sigma*np.exp(-(x - mean)**2/2/sigma**2)
 
 
-@njit(fastmath=True)
+@njit(fastmath=True, cache=True)
 def wrap(x, L):
     '''Fast scalar mod implementation'''
     L2 = L/2
@@ -120,435 +130,383 @@ def wrap(x, L):
     return x
 
 
-@njit(parallel=True, fastmath=True)
-def gen_cent(pos, vel, mass, ids, multis, randoms, vdev, deltac, fenv, 
-    LRG_design_array, LRG_decorations_array, ELG_design_array, 
-    ELG_decorations_array, QSO_design_array, QSO_decorations_array, 
-    rsd, inv_velz2kms, lbox, want_LRG, want_ELG, want_QSO, Nthread):
+@njit(fastmath=True, cache=True)
+def empty_catalog(N, pos_like, mass_like, id_like):
     """
-    Generate central galaxies in place in memory with a two pass numba parallel implementation. 
+    Allocate an uninitialized ``GalaxyCatalog`` of length ``N``. Positions and velocities 
+    take the dtype of ``pos_like``, masses of ``mass_like`` and ids of ``id_like``.
     """
+    return GalaxyCatalog(np.empty(N, dtype = pos_like.dtype), np.empty(N, dtype = pos_like.dtype), 
+        np.empty(N, dtype = pos_like.dtype), np.empty(N, dtype = pos_like.dtype), 
+        np.empty(N, dtype = pos_like.dtype), np.empty(N, dtype = pos_like.dtype), 
+        np.empty(N, dtype = mass_like.dtype), np.empty(N, dtype = id_like.dtype))
 
-    # parse out the hod parameters 
-    logM_cut_L, logM1_L, sigma_L, alpha_L, kappa_L = \
-        LRG_design_array[0], LRG_design_array[1], LRG_design_array[2], LRG_design_array[3], LRG_design_array[4]
-    ic_L, alpha_c_L, Ac_L, Bc_L = LRG_decorations_array[10], LRG_decorations_array[0], \
-        LRG_decorations_array[6], LRG_decorations_array[8]
 
-    pmax_E, Q_E, logM_cut_E, kappa_E, sigma_E, logM1_E, alpha_E, gamma_E, A_E = \
-        ELG_design_array[0], ELG_design_array[1], ELG_design_array[2], ELG_design_array[3], ELG_design_array[4],\
-        ELG_design_array[5], ELG_design_array[6], ELG_design_array[7], ELG_design_array[8]
-    alpha_c_E, Ac_E, Bc_E = ELG_decorations_array[0], ELG_decorations_array[6], ELG_decorations_array[8]
-
-    pmax_Q, logM_cut_Q, kappa_Q, sigma_Q, logM1_Q, alpha_Q, A_Q = \
-        QSO_design_array[0], QSO_design_array[1], QSO_design_array[2], QSO_design_array[3], QSO_design_array[4],\
-        QSO_design_array[5], QSO_design_array[6]
-    alpha_c_Q, Ac_Q, Bc_Q = QSO_decorations_array[0], QSO_decorations_array[6], QSO_decorations_array[8]
+@njit(parallel=True, fastmath=True, cache=True)
+def fill_cent(gidx, kstart, gstart, counts, hpos_x, hpos_y, hpos_z, hvel_x, hvel_y, hvel_z, 
+    mass, ids, vdev, alpha_c, rsd, inv_velz2kms, lbox, out):
+    """
+    Fill the central galaxy catalog ``out`` of one tracer. Block ``bid`` of the kept halo 
+    offsets starts at ``gidx[kstart[bid]]``, holds ``counts[bid]`` halos and is written to 
+    the galaxy arrays starting at ``gstart[bid]``. The offsets count from the first halo 
+    of the block, ``bid * BLOCK_SIZE``.
+    """
+    # unpack outside the parallel loop, parfors drop writes made through tuple attributes
+    out_x, out_y, out_z, out_vx, out_vy, out_vz, out_mass, out_id = out
+    for bid in numba.prange(len(counts)):
+        j = gstart[bid]
+        hlo = bid * BLOCK_SIZE
+        for k in range(kstart[bid], kstart[bid] + counts[bid]):
+            i = hlo + gidx[k]
+            # loop thru three directions to assign galaxy velocities and positions
+            out_x[j] = hpos_x[i]
+            out_y[j] = hpos_y[i]
+            out_z[j] = hpos_z[i]
+            if alpha_c == 0: # no velocity bias, loop invariant so the branch is hoisted
+                out_vx[j] = hvel_x[i]
+                out_vy[j] = hvel_y[i]
+                out_vz[j] = hvel_z[i]
+            else:
+                dv = alpha_c * vdev[i] # velocity bias, same in all three directions
+                out_vx[j] = hvel_x[i] + dv
+                out_vy[j] = hvel_y[i] + dv
+                out_vz[j] = hvel_z[i] + dv
+            # rsd only applies to the z direction
+            if rsd:
+                out_z[j] = wrap(hpos_z[i] + out_vz[j] * inv_velz2kms, lbox)
+            out_mass[j] = mass[i]
+            out_id[j] = ids[i]
+            j += 1
 
-    H = len(mass)
 
-    numba.set_num_threads(Nthread)
-    Nout = np.zeros((Nthread, 3, 8), dtype = np.int64)
-    hstart = np.rint(np.linspace(0, H, Nthread + 1)) # starting index of each thread
-
-    keep = np.empty(H, dtype = np.int8) # mask array tracking which halos to keep
-
-    # figuring out the number of halos kept for each thread
-    for tid in numba.prange(Nthread):
-        for i in range(hstart[tid], hstart[tid + 1]):
-            # first create the markers between 0 and 1 for different tracers
-            LRG_marker = 0
-            if want_LRG:
-                # do assembly bias and secondary bias
-                logM_cut_L_temp = logM_cut_L + Ac_L * deltac[i] + Bc_L * fenv[i]
-                LRG_marker += n_cen_LRG(mass[i], logM_cut_L_temp, sigma_L) * ic_L * multis[i]
-            ELG_marker = LRG_marker
-            if want_ELG:
-                logM_cut_E_temp = logM_cut_E + Ac_E * deltac[i] + Bc_E * fenv[i]
-                ELG_marker += N_cen_ELG_v1(mass[i], pmax_E, Q_E, logM_cut_E_temp, sigma_E, gamma_E) * multis[i]
-            QSO_marker = ELG_marker
-            if want_QSO:
-                logM_cut_Q_temp = logM_cut_Q + Ac_Q * deltac[i] + Bc_Q * fenv[i]
-                QSO_marker += N_cen_QSO(mass[i], pmax_Q, logM_cut_Q, sigma_Q)
-
-            if randoms[i] <= LRG_marker:
-                Nout[tid, 0, 0] += 1 # counting
-                keep[i] = 1
-            elif randoms[i] <= ELG_marker:
-                Nout[tid, 1, 0] += 1 # counting
-                keep[i] = 2
-            elif randoms[i] <= QSO_marker:
-                Nout[tid, 2, 0] += 1 # counting
-                keep[i] = 3
+@njit(parallel=True, fastmath=True, cache=True)
+def fill_sats(gidx, kstart, gstart, counts, ppos_x, ppos_y, ppos_z, pvel_x, pvel_y, pvel_z, 
+    hvel_x, hvel_y, hvel_z, hmass, hid, alpha_s, rsd, inv_velz2kms, lbox, out):
+    """
+    Fill the satellite galaxy arrays of one tracer, same layout as ``fill_cent``. 
+    """
+    # unpack outside the parallel loop, parfors drop writes made through tuple attributes
+    out_x, out_y, out_z, out_vx, out_vy, out_vz, out_mass, out_id = out
+    for bid in numba.prange(len(counts)):
+        j = gstart[bid]
+        hlo = bid * BLOCK_SIZE
+        for k in range(kstart[bid], kstart[bid] + counts[bid]):
+            i = hlo + gidx[k]
+            out_x[j] = ppos_x[i]
+            out_y[j] = ppos_y[i]
+            out_z[j] = ppos_z[i]
+            if alpha_s == 1: # no velocity bias, satellites move with their particles
+                out_vx[j] = pvel_x[i]
+                out_vy[j] = pvel_y[i]
+                out_vz[j] = pvel_z[i]
             else:
-                keep[i] = 0
-
-    # compose galaxy array, first create array of galaxy starting indices for the threads
-    gstart = np.empty((Nthread + 1, 3), dtype = np.int64)
-    gstart[0, :] = 0
-    gstart[1:, 0] = Nout[:, 0, 0].cumsum()
-    gstart[1:, 1] = Nout[:, 1, 0].cumsum()
-    gstart[1:, 2] = Nout[:, 2, 0].cumsum()
-
-    # galaxy arrays
-    N_lrg = gstart[-1, 0]
-    lrg_x = np.empty(N_lrg, dtype = mass.dtype)
-    lrg_y = np.empty(N_lrg, dtype = mass.dtype)
-    lrg_z = np.empty(N_lrg, dtype = mass.dtype)
-    lrg_vx = np.empty(N_lrg, dtype = mass.dtype)
-    lrg_vy = np.empty(N_lrg, dtype = mass.dtype)
-    lrg_vz = np.empty(N_lrg, dtype = mass.dtype)
-    lrg_mass = np.empty(N_lrg, dtype = mass.dtype)
-    lrg_id = np.empty(N_lrg, dtype = ids.dtype)
-
-    # galaxy arrays
-    N_elg = gstart[-1, 1]
-    elg_x = np.empty(N_elg, dtype = mass.dtype)
-    elg_y = np.empty(N_elg, dtype = mass.dtype)
-    elg_z = np.empty(N_elg, dtype = mass.dtype)
-    elg_vx = np.empty(N_elg, dtype = mass.dtype)
-    elg_vy = np.empty(N_elg, dtype = mass.dtype)
-    elg_vz = np.empty(N_elg, dtype = mass.dtype)
-    elg_mass = np.empty(N_elg, dtype = mass.dtype)
-    elg_id = np.empty(N_elg, dtype = ids.dtype)
-
-    # galaxy arrays
-    N_qso = gstart[-1, 2]
-    qso_x = np.empty(N_qso, dtype = mass.dtype)
-    qso_y = np.empty(N_qso, dtype = mass.dtype)
-    qso_z = np.empty(N_qso, dtype = mass.dtype)
-    qso_vx = np.empty(N_qso, dtype = mass.dtype)
-    qso_vy = np.empty(N_qso, dtype = mass.dtype)
-    qso_vz = np.empty(N_qso, dtype = mass.dtype)
-    qso_mass = np.empty(N_qso, dtype = mass.dtype)
-    qso_id = np.empty(N_qso, dtype = ids.dtype)
-
-    # fill in the galaxy arrays
-    for tid in numba.prange(Nthread):
-        j1, j2, j3 = gstart[tid]
-        for i in range(hstart[tid], hstart[tid + 1]):
-            if keep[i] == 1:
-                # loop thru three directions to assign galaxy velocities and positions
-                lrg_x[j1] = pos[i,0]
-                lrg_vx[j1] = vel[i,0] + alpha_c_L * vdev[i] # velocity bias
-                lrg_y[j1] = pos[i,1]
-                lrg_vy[j1] = vel[i,1] + alpha_c_L * vdev[i] # velocity bias
-                lrg_z[j1] = pos[i,2]
-                lrg_vz[j1] = vel[i,2] + alpha_c_L * vdev[i] # velocity bias
-                # rsd only applies to the z direction
-                if rsd:
-                    lrg_z[j1] = wrap(pos[i,2] + lrg_vz[j1] * inv_velz2kms, lbox)
-                lrg_mass[j1] = mass[i]
-                lrg_id[j1] = ids[i]
-                j1 += 1
-            elif keep[i] == 2:
-                # loop thru three directions to assign galaxy velocities and positions
-                elg_x[j2] = pos[i,0]
-                elg_vx[j2] = vel[i,0] + alpha_c_E * vdev[i] # velocity bias
-                elg_y[j2] = pos[i,1]
-                elg_vy[j2] = vel[i,1] + alpha_c_E * vdev[i] # velocity bias
-                elg_z[j2] = pos[i,2]
-                elg_vz[j2] = vel[i,2] + alpha_c_E * vdev[i] # velocity bias
-                # rsd only applies to the z direction
-                if rsd:
-                    elg_z[j2] = wrap(pos[i,2] + elg_vz[j2] * inv_velz2kms, lbox)
-                elg_mass[j2] = mass[i]
-                elg_id[j2] = ids[i]
-                j2 += 1
-            elif keep[i] == 3:
-                # loop thru three directions to assign galaxy velocities and positions
-                qso_x[j3] = pos[i,0]
-                qso_vx[j3] = vel[i,0] + alpha_c_Q * vdev[i] # velocity bias
-                qso_y[j3] = pos[i,1]
-                qso_vy[j3] = vel[i,1] + alpha_c_Q * vdev[i] # velocity bias
-                qso_z[j3] = pos[i,2]
-                qso_vz[j3] = vel[i,2] + alpha_c_Q * vdev[i] # velocity bias
-                # rsd only applies to the z direction
-                if rsd:
-                    qso_z[j3] = wrap(pos[i,2] + qso_vz[j3] * inv_velz2kms, lbox)
-                qso_mass[j3] = mass[i]
-                qso_id[j3] = ids[i]
-                j3 += 1
-        # assert j == gstart[tid + 1]
-
-    LRG_dict = Dict.empty(key_type = types.unicode_type, value_type = float_array)
-    ELG_dict = Dict.empty(key_type = types.unicode_type, value_type = float_array)
-    QSO_dict = Dict.empty(key_type = types.unicode_type, value_type = float_array)
-    ID_dict = Dict.empty(key_type = types.unicode_type, value_type = int_array)
-    LRG_dict['x'] = lrg_x
-    LRG_dict['y'] = lrg_y
-    LRG_dict['z'] = lrg_z
-    LRG_dict['vx'] = lrg_vx
-    LRG_dict['vy'] = lrg_vy
-    LRG_dict['vz'] = lrg_vz
-    LRG_dict['mass'] = lrg_mass
-    ID_dict['LRG'] = lrg_id
-
-    ELG_dict['x'] = elg_x
-    ELG_dict['y'] = elg_y
-    ELG_dict['z'] = elg_z
-    ELG_dict['vx'] = elg_vx
-    ELG_dict['vy'] = elg_vy
-    ELG_dict['vz'] = elg_vz
-    ELG_dict['mass'] = elg_mass
-    ID_dict['ELG'] = elg_id
-
-    QSO_dict['x'] = qso_x
-    QSO_dict['y'] = qso_y
-    QSO_dict['z'] = qso_z
-    QSO_dict['vx'] = qso_vx
-    QSO_dict['vy'] = qso_vy
-    QSO_dict['vz'] = qso_vz
-    QSO_dict['mass'] = qso_mass
-    ID_dict['QSO'] = qso_id
-    return LRG_dict, ELG_dict, QSO_dict, ID_dict
-
-
-@njit(parallel = True, fastmath = True)
-def gen_sats(ppos, pvel, hvel, hmass, hid, weights, randoms, hdeltac, hfenv, 
-    enable_ranks, ranks, ranksv, ranksp, ranksr, 
-    LRG_design_array, LRG_decorations_array, ELG_design_array, ELG_decorations_array,
-    QSO_design_array, QSO_decorations_array,
-    rsd, inv_velz2kms, lbox, Mpart, want_LRG, want_ELG, want_QSO, Nthread):
+                out_vx[j] = hvel_x[i] + alpha_s * (pvel_x[i] - hvel_x[i]) # velocity bias
+                out_vy[j] = hvel_y[i] + alpha_s * (pvel_y[i] - hvel_y[i]) # velocity bias
+                out_vz[j] = hvel_z[i] + alpha_s * (pvel_z[i] - hvel_z[i]) # velocity bias
+            if rsd:
+                out_z[j] = wrap(out_z[j] + out_vz[j] * inv_velz2kms, lbox)
+            out_mass[j] = hmass[i]
+            out_id[j] = hid[i]
+            j += 1
 
+
+def _make_gen_cent(want_LRG, want_ELG, want_QSO):
     """
-    Generate satellite galaxies in place in memory with a two pass numba parallel implementation. 
+    Compile ``gen_cent`` for one combination of the tracer flags. The flags are frozen 
+    into the kernel as compile-time constants, so that the code of the disabled tracers 
+    is compiled out.
     """
+    @njit(parallel=True, fastmath=True, cache=True)
+    def gen_cent(logmass, multis, randoms, deltac, fenv, 
+        LRG_design_array, LRG_decorations_array, ELG_design_array, 
+        ELG_decorations_array, QSO_design_array, QSO_decorations_array):
+        """
+        Select the halos hosting central galaxies with a numba parallel implementation. 
+        A single pass over the halos classifies them and compacts the indices of the kept 
+        halos, see ``gen_gals`` for how these are turned into galaxies. 
+        """
+
+        # parse out the hod parameters 
+        logM_cut_L, logM1_L, sigma_L, alpha_L, kappa_L = \
+            LRG_design_array[0], LRG_design_array[1], LRG_design_array[2], LRG_design_array[3], LRG_design_array[4]
+        ic_L, alpha_c_L, Ac_L, Bc_L = LRG_decorations_array[10], LRG_decorations_array[0], \
+            LRG_decorations_array[6], LRG_decorations_array[8]
 
-    # standard hod design
-    logM_cut_L, logM1_L, sigma_L, alpha_L, kappa_L = \
-        LRG_design_array[0], LRG_design_array[1], LRG_design_array[2], LRG_design_array[3], LRG_design_array[4]
-    alpha_s_L, s_L, s_v_L, s_p_L, s_r_L, Ac_L, As_L, Bc_L, Bs_L, ic_L = \
-        LRG_decorations_array[1], LRG_decorations_array[2], LRG_decorations_array[3], LRG_decorations_array[4], \
-        LRG_decorations_array[5], LRG_decorations_array[6], LRG_decorations_array[7], LRG_decorations_array[8], \
-        LRG_decorations_array[9], LRG_decorations_array[10]
+        pmax_E, Q_E, logM_cut_E, kappa_E, sigma_E, logM1_E, alpha_E, gamma_E, A_E = \
+            ELG_design_array[0], ELG_design_array[1], ELG_design_array[2], ELG_design_array[3], ELG_design_array[4],\
+            ELG_design_array[5], ELG_design_array[6], ELG_design_array[7], ELG_design_array[8]
+        alpha_c_E, Ac_E, Bc_E = ELG_decorations_array[0], ELG_decorations_array[6], ELG_decorations_array[8]
 
-    pmax_E, Q_E, logM_cut_E, kappa_E, sigma_E, logM1_E, alpha_E, gamma_E, A_E = \
-        ELG_design_array[0], ELG_design_array[1], ELG_design_array[2], ELG_design_array[3], ELG_design_array[4],\
-        ELG_design_array[5], ELG_design_array[6], ELG_design_array[7], ELG_design_array[8]
-    alpha_s_E, s_E, s_v_E, s_p_E, s_r_E, Ac_E, As_E, Bc_E, Bs_E = \
-        ELG_decorations_array[1], ELG_decorations_array[2], ELG_decorations_array[3], ELG_decorations_array[4], \
-        ELG_decorations_array[5], ELG_decorations_array[6], ELG_decorations_array[7], ELG_decorations_array[8], \
-        ELG_decorations_array[9]
+        pmax_Q, logM_cut_Q, kappa_Q, sigma_Q, logM1_Q, alpha_Q, A_Q = \
+            QSO_design_array[0], QSO_design_array[1], QSO_design_array[2], QSO_design_array[3], QSO_design_array[4],\
+            QSO_design_array[5], QSO_design_array[6]
+        alpha_c_Q, Ac_Q, Bc_Q = QSO_decorations_array[0], QSO_decorations_array[6], QSO_decorations_array[8]
+
+        H = len(logmass)
+
+        # the halos are processed in fixed-size blocks, small enough for a block's tags to
+        # stay in cache between classification and compaction, and numerous enough for
+        # prange to balance the load across the threads
+        Nblock = (H + BLOCK_SIZE - 1) // BLOCK_SIZE
+        # per-block counts per tracer, each block counts locally and stores its totals once
+        Nout = np.zeros((Nblock, 3), dtype = np.int64)
+
+        # offsets of the kept halos from the start of their block, compacted into the head of
+        # each block's own range [bid * BLOCK_SIZE, (bid + 1) * BLOCK_SIZE) and grouped by
+        # tracer (LRG, ELG, QSO). The offsets are below BLOCK_SIZE, so 2 bytes per halo
+        gidx = np.empty(H, dtype = np.uint16)
+
+        # single pass over the halos, classifying them and recording the kept ones
+        for bid in numba.prange(Nblock):
+            hlo = bid * BLOCK_SIZE
+            hhi = min(hlo + BLOCK_SIZE, H)
+            tkeep = np.empty(hhi - hlo, dtype = np.int8) # block-local tracer tags
+            tcount = np.zeros(4, dtype = np.int64) # block-local counts, indexed by tag
+            for i in range(hlo, hhi):
+                # the log mass is shared by all the tracers
+                logM = logmass[i]
+                # the markers between 0 and 1 are cumulative over the tracers (LRG, ELG, QSO),
+                # a halo taken by one tracer never needs the HODs of the later ones
+                marker = 0.
+                tag = 0
+                if want_LRG:
+                    # do assembly bias and secondary bias
+                    logM_cut_L_temp = logM_cut_L + Ac_L * deltac[i] + Bc_L * fenv[i]
+                    marker += n_cen_LRG(logM, logM_cut_L_temp, sigma_L) * ic_L * multis[i]
+                    if randoms[i] <= marker:
+                        tag = 1
+                if want_ELG and tag == 0:
+                    logM_cut_E_temp = logM_cut_E + Ac_E * deltac[i] + Bc_E * fenv[i]
+                    marker += N_cen_ELG_v1(logM, pmax_E, Q_E, logM_cut_E_temp, sigma_E, gamma_E) * multis[i]
+                    if randoms[i] <= marker:
+                        tag = 2
+                if want_QSO and tag == 0:
+                    logM_cut_Q_temp = logM_cut_Q + Ac_Q * deltac[i] + Bc_Q * fenv[i]
+                    marker += N_cen_QSO(logM, pmax_Q, logM_cut_Q, sigma_Q)
+                    if randoms[i] <= marker:
+                        tag = 3
+
+                tkeep[i - hlo] = tag
+                tcount[tag] += 1 # counting, untagged halos land in tcount[0]
+            Nout[bid, :] = tcount[1:]
+
+            # compact the kept halo indices, the block's counts are now known
+            k1 = hlo
+            k2 = k1 + Nout[bid, 0]
+            k3 = k2 + Nout[bid, 1]
+            for i in range(hlo, hhi):
+                if tkeep[i - hlo] == 1:
+                    gidx[k1] = i - hlo
+                    k1 += 1
+                elif tkeep[i - hlo] == 2:
+                    gidx[k2] = i - hlo
+                    k2 += 1
+                elif tkeep[i - hlo] == 3:
+                    gidx[k3] = i - hlo
+                    k3 += 1
+
+        # where each block's kept halos of each tracer start in gidx
+        kstart = np.empty((Nblock, 3), dtype = np.int64)
+        kstart[:, 0] = np.arange(Nblock) * BLOCK_SIZE
+        kstart[:, 1] = kstart[:, 0] + Nout[:, 0]
+        kstart[:, 2] = kstart[:, 1] + Nout[:, 1]
+        return gidx, kstart, Nout
+    return gen_cent
+
+_gen_cent_kernels = {}
+
+def gen_cent(logmass, multis, randoms, deltac, fenv, 
+    LRG_design_array, LRG_decorations_array, ELG_design_array, 
+    ELG_decorations_array, QSO_design_array, QSO_decorations_array, 
+    want_LRG, want_ELG, want_QSO, Nthread):
+    """
+    Select the halos hosting central galaxies, dispatching to the kernel compiled for the 
+    given flags. Returns the compacted offsets of the kept halos ``gidx``, and for each 
+    block of ``BLOCK_SIZE`` halos and tracer (LRG, ELG, QSO) where its kept halos start 
+    in ``gidx`` and how many there are, as two (Nblock, 3) arrays.
+    """
+    flags = (bool(want_LRG), bool(want_ELG), bool(want_QSO))
+    if flags not in _gen_cent_kernels:
+        _gen_cent_kernels[flags] = _make_gen_cent(*flags)
+    # set outside the kernel, numba cannot cache a function that sets the thread count
+    numba.set_num_threads(Nthread)
+    return _gen_cent_kernels[flags](logmass, multis, randoms, deltac, fenv, 
+        LRG_design_array, LRG_decorations_array, ELG_design_array, 
+        ELG_decorations_array, QSO_design_array, QSO_decorations_array)
 
-    pmax_Q, logM_cut_Q, kappa_Q, sigma_Q, logM1_Q, alpha_Q, A_Q = \
-        QSO_design_array[0], QSO_design_array[1], QSO_design_array[2], QSO_design_array[3], QSO_design_array[4],\
-        QSO_design_array[5], QSO_design_array[6]
-    alpha_s_Q, s_Q, s_v_Q, s_p_Q, s_r_Q, Ac_Q, As_Q, Bc_Q, Bs_Q = \
-        QSO_decorations_array[1], QSO_decorations_array[2], QSO_decorations_array[3], QSO_decorations_array[4], \
-        QSO_decorations_array[5], QSO_decorations_array[6], QSO_decorations_array[7], QSO_decorations_array[8], \
-        QSO_decorations_array[9]
 
-    H = len(hmass) # num of particles
+def _make_gen_sats(want_LRG, want_ELG, want_QSO, enable_ranks):
+    """
+    Compile ``gen_sats`` for one combination of the boolean flags, see ``_make_gen_cent``.
+    """
+    @njit(parallel = True, fastmath = True, cache = True)
+    def gen_sats(hmass, hlogmass, weights, randoms, hdeltac, hfenv, 
+        ranks, ranksv, ranksp, ranksr, 
+        LRG_design_array, LRG_decorations_array, ELG_design_array, ELG_decorations_array,
+        QSO_design_array, QSO_decorations_array, Mpart):
+
+        """
+        Select the particles hosting satellite galaxies with a numba parallel implementation. 
+        A single pass over the particles classifies them and compacts the indices of the kept 
+        particles, see ``gen_gals`` for how these are turned into galaxies. 
+        """
+
+        # standard hod design
+        logM_cut_L, logM1_L, sigma_L, alpha_L, kappa_L = \
+            LRG_design_array[0], LRG_design_array[1], LRG_design_array[2], LRG_design_array[3], LRG_design_array[4]
+        alpha_s_L, s_L, s_v_L, s_p_L, s_r_L, Ac_L, As_L, Bc_L, Bs_L, ic_L = \
+            LRG_decorations_array[1], LRG_decorations_array[2], LRG_decorations_array[3], LRG_decorations_array[4], \
+            LRG_decorations_array[5], LRG_decorations_array[6], LRG_decorations_array[7], LRG_decorations_array[8], \
+            LRG_decorations_array[9], LRG_decorations_array[10]
 
-    numba.set_num_threads(Nthread)
-    Nout = np.zeros((Nthread, 3, 8), dtype = np.int64)
-    hstart = np.rint(np.linspace(0, H, Nthread + 1)) # starting index of each thread
-
-    keep = np.empty(H, dtype = np.int8) # mask array tracking which halos to keep
-
-    # figuring out the number of particles kept for each thread
-    for tid in numba.prange(Nthread): #numba.prange(Nthread):
-        for i in range(hstart[tid], hstart[tid + 1]):
-            # print(logM1, As, hdeltac[i], Bs, hfenv[i])
-            LRG_marker = 0
-            if want_LRG:
-                M1_L_temp = 10**(logM1_L + As_L * hdeltac[i] + Bs_L * hfenv[i])
-                logM_cut_L_temp = logM_cut_L + Ac_L * hdeltac[i] + Bc_L * hfenv[i]
-                base_p_L = n_sat_LRG_modified(hmass[i], logM_cut_L_temp, 
-                    10**logM_cut_L_temp, M1_L_temp, sigma_L, alpha_L, kappa_L) * weights[i] * ic_L
-                if enable_ranks:
-                    decorator_L = 1 + s_L * ranks[i] + s_v_L * ranksv[i] + s_p_L * ranksp[i] + s_r_L * ranksr[i]
-                    exp_sat = base_p_L * decorator_L
-                else:
-                    exp_sat = base_p_L
-                LRG_marker += exp_sat
-            ELG_marker = LRG_marker
-            if want_ELG:
-                M1_E_temp = 10**(logM1_E + As_E * hdeltac[i] + Bs_E * hfenv[i])
-                logM_cut_E_temp = logM_cut_E + Ac_E * hdeltac[i] + Bc_E * hfenv[i]
-                base_p_E = N_sat_generic(
-                    hmass[i], 10**logM_cut_E_temp, kappa_E, M1_E_temp, alpha_E, A_E) * weights[i]
-                if enable_ranks:
-                    decorator_E = 1 + s_E * ranks[i] + s_v_E * ranksv[i] + s_p_E * ranksp[i] + s_r_E * ranksr[i]
-                    exp_sat = base_p_E * decorator_E
-                else:
-                    exp_sat = base_p_E
-                ELG_marker += exp_sat
-            QSO_marker = ELG_marker
-            if want_QSO:
-                M1_Q_temp = 10**(logM1_Q + As_Q * hdeltac[i] + Bs_Q * hfenv[i])
-                logM_cut_Q_temp = logM_cut_Q + Ac_Q * hdeltac[i] + Bc_Q * hfenv[i]
-                base_p_Q = N_sat_generic(
-                    hmass[i], 10**logM_cut_Q_temp, kappa_Q, M1_Q_temp, alpha_Q, A_Q) * weights[i]
-                if enable_ranks:
-                    decorator_Q = 1 + s_Q * ranks[i] + s_v_Q * ranksv[i] + s_p_Q * ranksp[i] + s_r_Q * ranksr[i]
-                    exp_sat = base_p_Q * decorator_Q
-                else:
-                    exp_sat = base_p_Q
-                QSO_marker += exp_sat
-
-            if randoms[i] <= LRG_marker:
-                Nout[tid, 0, 0] += 1 # counting
-                keep[i] = 1
-            elif randoms[i] <= ELG_marker:
-                Nout[tid, 1, 0] += 1 # counting
-                keep[i] = 2
-            elif randoms[i] <= QSO_marker:
-                Nout[tid, 2, 0] += 1 # counting
-                keep[i] = 3    
-            else:
-                keep[i] = 0
-
-    # compose galaxy array, first create array of galaxy starting indices for the threads
-    gstart = np.empty((Nthread + 1, 3), dtype = np.int64)
-    gstart[0, :] = 0
-    gstart[1:, 0] = Nout[:, 0, 0].cumsum()
-    gstart[1:, 1] = Nout[:, 1, 0].cumsum()
-    gstart[1:, 2] = Nout[:, 2, 0].cumsum()
-
-    # galaxy arrays
-    N_lrg = gstart[-1, 0]
-    lrg_x = np.empty(N_lrg, dtype = hmass.dtype)
-    lrg_y = np.empty(N_lrg, dtype = hmass.dtype)
-    lrg_z = np.empty(N_lrg, dtype = hmass.dtype)
-    lrg_vx = np.empty(N_lrg, dtype = hmass.dtype)
-    lrg_vy = np.empty(N_lrg, dtype = hmass.dtype)
-    lrg_vz = np.empty(N_lrg, dtype = hmass.dtype)
-    lrg_mass = np.empty(N_lrg, dtype = hmass.dtype)
-    lrg_id = np.empty(N_lrg, dtype = hid.dtype)
-
-    # galaxy arrays
-    N_elg = gstart[-1, 1]
-    elg_x = np.empty(N_elg, dtype = hmass.dtype)
-    elg_y = np.empty(N_elg, dtype = hmass.dtype)
-    elg_z = np.empty(N_elg, dtype = hmass.dtype)
-    elg_vx = np.empty(N_elg, dtype = hmass.dtype)
-    elg_vy = np.empty(N_elg, dtype = hmass.dtype)
-    elg_vz = np.empty(N_elg, dtype = hmass.dtype)
-    elg_mass = np.empty(N_elg, dtype = hmass.dtype)
-    elg_id = np.empty(N_elg, dtype = hid.dtype)
-
-    # galaxy arrays
-    N_qso = gstart[-1, 2]
-    qso_x = np.empty(N_qso, dtype = hmass.dtype)
-    qso_y = np.empty(N_qso, dtype = hmass.dtype)
-    qso_z = np.empty(N_qso, dtype = hmass.dtype)
-    qso_vx = np.empty(N_qso, dtype = hmass.dtype)
-    qso_vy = np.empty(N_qso, dtype = hmass.dtype)
-    qso_vz = np.empty(N_qso, dtype = hmass.dtype)
-    qso_mass = np.empty(N_qso, dtype = hmass.dtype)
-    qso_id = np.empty(N_qso, dtype = hid.dtype)
-
-    # fill in the galaxy arrays
-    for tid in numba.prange(Nthread):
-        j1, j2, j3 = gstart[tid]
-        for i in range(hstart[tid], hstart[tid + 1]):
-            if keep[i] == 1:
-                lrg_x[j1] = ppos[i, 0]
-                lrg_vx[j1] = hvel[i, 0] + alpha_s_L * (pvel[i, 0] - hvel[i, 0]) # velocity bias
-                lrg_y[j1] = ppos[i, 1]
-                lrg_vy[j1] = hvel[i, 1] + alpha_s_L * (pvel[i, 1] - hvel[i, 1]) # velocity bias
-                lrg_z[j1] = ppos[i, 2]
-                lrg_vz[j1] = hvel[i, 2] + alpha_s_L * (pvel[i, 2] - hvel[i, 2]) # velocity bias
-                if rsd:
-                    lrg_z[j1] = wrap(lrg_z[j1] + lrg_vz[j1] * inv_velz2kms, lbox)
-                lrg_mass[j1] = hmass[i]
-                lrg_id[j1] = hid[i]
-                j1 += 1
-            elif keep[i] == 2:
-                elg_x[j2] = ppos[i, 0]
-                elg_vx[j2] = hvel[i, 0] + alpha_s_E * (pvel[i, 0] - hvel[i, 0]) # velocity bias
-                elg_y[j2] = ppos[i, 1]
-                elg_vy[j2] = hvel[i, 1] + alpha_s_E * (pvel[i, 1] - hvel[i, 1]) # velocity bias
-                elg_z[j2] = ppos[i, 2]
-                elg_vz[j2] = hvel[i, 2] + alpha_s_E * (pvel[i, 2] - hvel[i, 2]) # velocity bias
-                if rsd:
-                    elg_z[j2] = wrap(elg_z[j2] + elg_vz[j2] * inv_velz2kms, lbox)
-                elg_mass[j2] = hmass[i]
-                elg_id[j2] = hid[i]
-                j2 += 1
-            elif keep[i] == 3:
-                qso_x[j3] = ppos[i, 0]
-                qso_vx[j3] = hvel[i, 0] + alpha_s_Q * (pvel[i, 0] - hvel[i, 0]) # velocity bias
-                qso_y[j3] = ppos[i, 1]
-                qso_vy[j3] = hvel[i, 1] + alpha_s_Q * (pvel[i, 1] - hvel[i, 1]) # velocity bias
-                qso_z[j3] = ppos[i, 2]
-                qso_vz[j3] = hvel[i, 2] + alpha_s_Q * (pvel[i, 2] - hvel[i, 2]) # velocity bias
-                if rsd:
-                    qso_z[j3] = wrap(qso_z[j3] + qso_vz[j3] * inv_velz2kms, lbox)
-                qso_mass[j3] = hmass[i]
-                qso_id[j3] = hid[i]
-                j3 += 1
-        # assert j == gstart[tid + 1]
-
-    LRG_dict = Dict.empty(key_type = types.unicode_type, value_type = float_array)
-    ELG_dict = Dict.empty(key_type = types.unicode_type, value_type = float_array)
-    QSO_dict = Dict.empty(key_type = types.unicode_type, value_type = float_array)
-    ID_dict = Dict.empty(key_type = types.unicode_type, value_type = int_array)
-    LRG_dict['x'] = lrg_x
-    LRG_dict['y'] = lrg_y
-    LRG_dict['z'] = lrg_z
-    LRG_dict['vx'] = lrg_vx
-    LRG_dict['vy'] = lrg_vy
-    LRG_dict['vz'] = lrg_vz
-    LRG_dict['mass'] = lrg_mass
-    ID_dict['LRG'] = lrg_id
-
-    ELG_dict['x'] = elg_x
-    ELG_dict['y'] = elg_y
-    ELG_dict['z'] = elg_z
-    ELG_dict['vx'] = elg_vx
-    ELG_dict['vy'] = elg_vy
-    ELG_dict['vz'] = elg_vz
-    ELG_dict['mass'] = elg_mass
-    ID_dict['ELG'] = elg_id
-
-    QSO_dict['x'] = qso_x
-    QSO_dict['y'] = qso_y
-    QSO_dict['z'] = qso_z
-    QSO_dict['vx'] = qso_vx
-    QSO_dict['vy'] = qso_vy
-    QSO_dict['vz'] = qso_vz
-    QSO_dict['mass'] = qso_mass
-    ID_dict['QSO'] = qso_id
-    return LRG_dict, ELG_dict, QSO_dict, ID_dict
-
-@njit(parallel = True, fastmath = True)
-def fast_concatenate(array1, array2, Nthread):
-    ''' Fast concatenate with numba parallel'''
-
-    N1 = len(array1)
-    N2 = len(array2)
-    if N1 == 0:
-        return array2
-    elif N2 == 0:
-        return array1
-
-    final_array = np.empty(N1 + N2, dtype = array1.dtype)
-    # if one thread, then no need to parallel
-    if Nthread == 1:
-        for i in range(N1):
-            final_array[i] = array1[i]
-        for j in range(N2):
-            final_array[j + N1] = array2[j]
-        return final_array
+        pmax_E, Q_E, logM_cut_E, kappa_E, sigma_E, logM1_E, alpha_E, gamma_E, A_E = \
+            ELG_design_array[0], ELG_design_array[1], ELG_design_array[2], ELG_design_array[3], ELG_design_array[4],\
+            ELG_design_array[5], ELG_design_array[6], ELG_design_array[7], ELG_design_array[8]
+        alpha_s_E, s_E, s_v_E, s_p_E, s_r_E, Ac_E, As_E, Bc_E, Bs_E = \
+            ELG_decorations_array[1], ELG_decorations_array[2], ELG_decorations_array[3], ELG_decorations_array[4], \
+            ELG_decorations_array[5], ELG_decorations_array[6], ELG_decorations_array[7], ELG_decorations_array[8], \
+            ELG_decorations_array[9]
 
+        pmax_Q, logM_cut_Q, kappa_Q, sigma_Q, logM1_Q, alpha_Q, A_Q = \
+            QSO_design_array[0], QSO_design_array[1], QSO_design_array[2], QSO_design_array[3], QSO_design_array[4],\
+            QSO_design_array[5], QSO_design_array[6]
+        alpha_s_Q, s_Q, s_v_Q, s_p_Q, s_r_Q, Ac_Q, As_Q, Bc_Q, Bs_Q = \
+            QSO_decorations_array[1], QSO_decorations_array[2], QSO_decorations_array[3], QSO_decorations_array[4], \
+            QSO_decorations_array[5], QSO_decorations_array[6], QSO_decorations_array[7], QSO_decorations_array[8], \
+            QSO_decorations_array[9]
+
+        # loop invariant mass scales, the secondary bias factors 10**(A*deltac + B*fenv)
+        # are only evaluated per particle when the corresponding parameters are non-zero
+        M_cut_L, M1_L = 10**logM_cut_L, 10**logM1_L
+        M_cut_E, M1_E = 10**logM_cut_E, 10**logM1_E
+        M_cut_Q, M1_Q = 10**logM_cut_Q, 10**logM1_Q
+        bias_cut_L, bias_M1_L = (Ac_L != 0 or Bc_L != 0), (As_L != 0 or Bs_L != 0)
+        bias_cut_E, bias_M1_E = (Ac_E != 0 or Bc_E != 0), (As_E != 0 or Bs_E != 0)
+        bias_cut_Q, bias_M1_Q = (Ac_Q != 0 or Bc_Q != 0), (As_Q != 0 or Bs_Q != 0)
+
+        H = len(hmass) # num of particles
+
+        # the particles are processed in fixed-size blocks, small enough for a block's tags to
+        # stay in cache between classification and compaction, and numerous enough for
+        # prange to balance the load across the threads
+        Nblock = (H + BLOCK_SIZE - 1) // BLOCK_SIZE
+        # per-block counts per tracer, each block counts locally and stores its totals once
+        Nout = np.zeros((Nblock, 3), dtype = np.int64)
+
+        # offsets of the kept particles from the start of their block, laid out as in gen_cent
+        gidx = np.empty(H, dtype = np.uint16)
+
+        # single pass over the particles, classifying them and recording the kept ones
+        for bid in numba.prange(Nblock):
+            hlo = bid * BLOCK_SIZE
+            hhi = min(hlo + BLOCK_SIZE, H)
+            tkeep = np.empty(hhi - hlo, dtype = np.int8) # block-local tracer tags
+            tcount = np.zeros(4, dtype = np.int64) # block-local counts, indexed by tag
+            for i in range(hlo, hhi):
+                LRG_marker = 0
+                if want_LRG:
+                    M1_L_temp = M1_L
+                    if bias_M1_L:
+                        M1_L_temp *= 10**(As_L * hdeltac[i] + Bs_L * hfenv[i])
+                    logM_cut_L_temp = logM_cut_L
+                    M_cut_L_temp = M_cut_L
+                    if bias_cut_L:
+                        logM_cut_L_temp += Ac_L * hdeltac[i] + Bc_L * hfenv[i]
+                        M_cut_L_temp = 10**logM_cut_L_temp
+                    base_p_L = n_sat_LRG_modified(hmass[i], hlogmass[i], logM_cut_L_temp, 
+                        M_cut_L_temp, M1_L_temp, sigma_L, alpha_L, kappa_L) * weights[i] * ic_L
+                    if enable_ranks:
+                        decorator_L = 1 + s_L * ranks[i] + s_v_L * ranksv[i] + s_p_L * ranksp[i] + s_r_L * ranksr[i]
+                        exp_sat = base_p_L * decorator_L
+                    else:
+                        exp_sat = base_p_L
+                    LRG_marker += exp_sat
+                ELG_marker = LRG_marker
+                if want_ELG:
+                    M1_E_temp = M1_E
+                    if bias_M1_E:
+                        M1_E_temp *= 10**(As_E * hdeltac[i] + Bs_E * hfenv[i])
+                    M_cut_E_temp = M_cut_E
+                    if bias_cut_E:
+                        M_cut_E_temp *= 10**(Ac_E * hdeltac[i] + Bc_E * hfenv[i])
+                    base_p_E = N_sat_generic(
+                        hmass[i], M_cut_E_temp, kappa_E, M1_E_temp, alpha_E, A_E) * weights[i]
+                    if enable_ranks:
+                        decorator_E = 1 + s_E * ranks[i] + s_v_E * ranksv[i] + s_p_E * ranksp[i] + s_r_E * ranksr[i]
+                        exp_sat = base_p_E * decorator_E
+                    else:
+                        exp_sat = base_p_E
+                    ELG_marker += exp_sat
+                QSO_marker = ELG_marker
+                if want_QSO:
+                    M1_Q_temp = M1_Q
+                    if bias_M1_Q:
+                        M1_Q_temp *= 10**(As_Q * hdeltac[i] + Bs_Q * hfenv[i])
+                    M_cut_Q_temp = M_cut_Q
+                    if bias_cut_Q:
+                        M_cut_Q_temp *= 10**(Ac_Q * hdeltac[i] + Bc_Q * hfenv[i])
+                    base_p_Q = N_sat_generic(
+                        hmass[i], M_cut_Q_temp, kappa_Q, M1_Q_temp, alpha_Q, A_Q) * weights[i]
+                    if enable_ranks:
+                        decorator_Q = 1 + s_Q * ranks[i] + s_v_Q * ranksv[i] + s_p_Q * ranksp[i] + s_r_Q * ranksr[i]
+                        exp_sat = base_p_Q * decorator_Q
+                    else:
+                        exp_sat = base_p_Q
+                    QSO_marker += exp_sat
+
+                # the first tracer whose cumulative marker reaches the random takes the particle,
+                # written as a select chain that is lowered without branches. The markers are not
+                # monotone when a negative decorator makes an expectation negative, so the tag
+                # cannot be taken from the number of markers below the random
+                r = randoms[i]
+                tag = 1 if r <= LRG_marker else (2 if r <= ELG_marker else (3 if r <= QSO_marker else 0))
+                tkeep[i - hlo] = tag
+                tcount[tag] += 1 # counting, untagged particles land in tcount[0]
+            Nout[bid, :] = tcount[1:]
+
+            # compact the kept particle indices, the block's counts are now known
+            k1 = hlo
+            k2 = k1 + Nout[bid, 0]
+            k3 = k2 + Nout[bid, 1]
+            for i in range(hlo, hhi):
+                if tkeep[i - hlo] == 1:
+                    gidx[k1] = i - hlo
+                    k1 += 1
+                elif tkeep[i - hlo] == 2:
+                    gidx[k2] = i - hlo
+                    k2 += 1
+                elif tkeep[i - hlo] == 3:
+                    gidx[k3] = i - hlo
+                    k3 += 1
+
+        # where each block's kept particles of each tracer start in gidx
+        kstart = np.empty((Nblock, 3), dtype = np.int64)
+        kstart[:, 0] = np.arange(Nblock) * BLOCK_SIZE
+        kstart[:, 1] = kstart[:, 0] + Nout[:, 0]
+        kstart[:, 2] = kstart[:, 1] + Nout[:, 1]
+        return gidx, kstart, Nout
+    return gen_sats
+
+_gen_sats_kernels = {}
+
+def gen_sats(hmass, hlogmass, weights, randoms, hdeltac, hfenv, 
+    enable_ranks, ranks, ranksv, ranksp, ranksr, 
+    LRG_design_array, LRG_decorations_array, ELG_design_array, ELG_decorations_array,
+    QSO_design_array, QSO_decorations_array,
+    Mpart, want_LRG, want_ELG, want_QSO, Nthread):
+    """
+    Select the particles hosting satellite galaxies, dispatching to the kernel compiled for 
+    the given flags. Returns the same selection layout as ``gen_cent``.
+    """
+    flags = (bool(want_LRG), bool(want_ELG), bool(want_QSO), bool(enable_ranks))
+    if flags not in _gen_sats_kernels:
+        _gen_sats_kernels[flags] = _make_gen_sats(*flags)
     numba.set_num_threads(Nthread)
-    Nthread1 = int(np.floor(Nthread * N1 / (N1 + N2)))
-    Nthread2 = Nthread - Nthread1
-    hstart1 = np.rint(np.linspace(0, N1, Nthread1 + 1))
-    hstart2 = np.rint(np.linspace(0, N2, Nthread2 + 1)) + N1
-
-    for tid in numba.prange(Nthread): #numba.prange(Nthread):
-        if tid < Nthread1:
-            for i in range(hstart1[tid], hstart1[tid + 1]):
-                final_array[i] = array1[i]
-        else:
-            for i in range(hstart2[tid - Nthread1], hstart2[tid + 1 - Nthread1]):
-                final_array[i] = array2[i - N1]
-    # final_array = np.concatenate((array1, array2))
-    return final_array
+    return _gen_sats_kernels[flags](hmass, hlogmass, weights, randoms, hdeltac, hfenv, 
+        ranks, ranksv, ranksp, ranksr, 
+        LRG_design_array, LRG_decorations_array, ELG_design_array, ELG_decorations_array,
+        QSO_design_array, QSO_decorations_array, Mpart)
+
 
 def gen_gals(halos_array, subsample, tracers, params, Nthread, enable_ranks, rsd):
     """
@@ -559,10 +517,12 @@ def gen_gals(halos_array, subsample, tracers, params, Nthread, enable_ranks, rsd
     ----------
 
     halos_array : dictionary of arrays 
-        a dictionary of halo properties (pos, vel, mass, id, randoms, ...)
+        a dictionary of halo properties (pos, vel, mass, log10 mass, id, randoms, ...), 
+        with positions and velocities stored as (3, N) float32 or float64 arrays
 
     subsample : dictionary of arrays
-        a dictionary of particle propoerties (pos, vel, hmass, hid, Np, subsampling, randoms, ...)
+        a dictionary of particle propoerties (pos, vel, hmass, log10 hmass, hid, Np, subsampling, randoms, ...), 
+        with positions and velocities stored as (3, N) float32 or float64 arrays
 
     tracers : dictionary of dictionaries
         Dictionary of multi-tracer HODs
@@ -688,47 +648,56 @@ def gen_gals(halos_array, subsample, tracers, params, Nthread, enable_ranks, rsd
     velz2kms = params['velz2kms']
     inv_velz2kms = 1/velz2kms
     lbox = params['Lbox']
-    # for each halo, generate central galaxies and output to file
-    LRG_dict_cent, ELG_dict_cent, QSO_dict_cent, ID_dict_cent = \
-    gen_cent(halos_array['hpos'], halos_array['hvel'], halos_array['hmass'], halos_array['hid'], halos_array['hmultis'], 
-             halos_array['hrandoms'], halos_array['hveldev'], halos_array['hdeltac'], halos_array['hfenv'], 
+    # for each halo, select the ones hosting central galaxies
+    cent_idx, cent_kstart, cent_counts = \
+    gen_cent(halos_array['hlogm'], halos_array['hmultis'], 
+             halos_array['hrandoms'], halos_array['hdeltac'], halos_array['hfenv'], 
              LRG_design_array, LRG_decorations_array, ELG_design_array, ELG_decorations_array, QSO_design_array, 
-             QSO_decorations_array, rsd, inv_velz2kms, lbox, want_LRG, want_ELG, want_QSO, Nthread)
+             QSO_decorations_array, want_LRG, want_ELG, want_QSO, Nthread)
     print("generating centrals took ", time.time() - start)
 
-
     start = time.time()
-    LRG_dict_sat, ELG_dict_sat, QSO_dict_sat, ID_dict_sat = \
-    gen_sats(subsample['ppos'], subsample['pvel'], subsample['phvel'], subsample['phmass'], subsample['phid'], 
+    sat_idx, sat_kstart, sat_counts = \
+    gen_sats(subsample['phmass'], subsample['phlogm'], 
              subsample['pweights'], subsample['prandoms'], subsample['pdeltac'], subsample['pfenv'], 
              enable_ranks, subsample['pranks'], subsample['pranksv'], subsample['pranksp'], subsample['pranksr'],
              LRG_design_array, LRG_decorations_array, ELG_design_array, ELG_decorations_array,
-             QSO_design_array, QSO_decorations_array, rsd, inv_velz2kms, lbox, params['Mpart'],
+             QSO_design_array, QSO_decorations_array, params['Mpart'],
              want_LRG, want_ELG, want_QSO, Nthread)
-
     print("generating satellites took ", time.time() - start)
 
-    # B.H. TODO: need a for loop above so we don't need to do this by hand
-    HOD_dict_sat = {'LRG': LRG_dict_sat, 'ELG': ELG_dict_sat, 'QSO': QSO_dict_sat}
-    HOD_dict_cent = {'LRG': LRG_dict_cent, 'ELG': ELG_dict_cent, 'QSO': QSO_dict_cent}
-    
-    # do a concatenate in numba parallel 
+    # both selections are counted, so each tracer gets a single catalog sized for its
+    # centrals and satellites, with the satellites written right after the centrals
     start = time.time()
+    decorations = {'LRG': LRG_decorations_array, 'ELG': ELG_decorations_array, 'QSO': QSO_decorations_array}
     HOD_dict = {}
     for tracer in tracers:
-        tracer_dict = {'Ncent':len(HOD_dict_cent[tracer]['x'])}
-        for k in HOD_dict_cent[tracer]:
-            tracer_dict[k] = fast_concatenate(HOD_dict_cent[tracer][k], HOD_dict_sat[tracer][k], Nthread)
-        tracer_dict['id'] = fast_concatenate(ID_dict_cent[tracer], ID_dict_sat[tracer], Nthread)
+        t = ('LRG', 'ELG', 'QSO').index(tracer)
+        alpha_c, alpha_s = decorations[tracer][0], decorations[tracer][1]
+        # starting index of each block in the output
+        cent_gstart = np.cumsum(cent_counts[:, t]) - cent_counts[:, t]
+        sat_gstart = np.cumsum(sat_counts[:, t]) - sat_counts[:, t]
+        Ncent, Nsat = int(cent_counts[:, t].sum()), int(sat_counts[:, t].sum())
+        cat = empty_catalog(Ncent + Nsat, halos_array['hpos'], halos_array['hmass'], halos_array['hid'])
+        fill_cent(cent_idx, cent_kstart[:, t], cent_gstart, cent_counts[:, t], 
+            *halos_array['hpos'], *halos_array['hvel'], halos_array['hmass'], halos_array['hid'], 
+            halos_array['hveldev'], alpha_c, rsd, inv_velz2kms, lbox, cat)
+        fill_sats(sat_idx, sat_kstart[:, t], sat_gstart + Ncent, sat_counts[:, t], 
+            *subsample['ppos'], *subsample['pvel'], *subsample['phvel'], subsample['phmass'], subsample['phid'], 
+            alpha_s, rsd, inv_velz2kms, lbox, cat)
+
+        # plain dict of the catalog's arrays, no copies
+        tracer_dict = {'Ncent': Ncent, **cat._asdict()}
         print(tracer, "number of galaxies ", len(tracer_dict['x']), 
-            ", satellite fraction ", len(HOD_dict_sat[tracer]['x'])/len(tracer_dict['x']))
+            ", satellite fraction ", Nsat/len(tracer_dict['x']))
         HOD_dict[tracer] = tracer_dict
     print("organizing outputs took ", time.time() - start)
     return HOD_dict
 
 
 def gen_gal_cat(halo_data, particle_data, tracers, params, Nthread = 16,
-    enable_ranks = False, rsd = True, write_to_disk = False, savedir = "./"):
+    enable_ranks = False, rsd = True, write_to_disk = False, savedir = "./", rng_seed = None, 
+    output_format = 'hdf5'):
     """
     pass on inputs to the gen_gals function and takes care of I/O
 
@@ -759,6 +728,16 @@ def gen_gal_cat(halo_data, particle_data, tracers, params, Nthread = 16,
     params : dict
         Dictionary of various simulation parameters. 
 
+    rng_seed : int or None
+        If given, draw a new realization: the halo and particle randoms and the central 
+        velocity deviations are redrawn from ``np.random.default_rng(rng_seed)`` instead of 
+        using the ones stored with the subsamples. Requires ``'hsigmav'`` in ``halo_data``.
+
+    output_format : str
+        Format of the galaxy files written if write_to_disk == True. ``'hdf5'`` (default) 
+        writes ``<tracer>s.h5`` with the catalog in the ``galaxies`` dataset, ``'ecsv'`` 
+        writes the text file ``<tracer>s.dat``. The metadata are kept in both. 
+
     Output
     ------
 
@@ -770,6 +749,20 @@ def gen_gal_cat(halo_data, particle_data, tracers, params, Nthread = 16,
 
     if not type(rsd) is bool:
         raise ValueError("Error: rsd has to be a boolean")
+    if output_format not in ('hdf5', 'ecsv'):
+        raise ValueError("Error: output_format has to be 'hdf5' or 'ecsv'")
+
+    # the thread pool is sized by NUMBA_NUM_THREADS at import, never ask for more than that
+    Nthread = max(1, min(int(Nthread), numba.config.NUMBA_NUM_THREADS))
+
+    if rng_seed is not None:
+        # all the draws of the realization come from one vectorized generator, the stored 
+        # subsample arrays are left untouched
+        rng = np.random.default_rng(rng_seed)
+        Nhalos, Nparts = len(halo_data['hrandoms']), len(particle_data['prandoms'])
+        halo_data = dict(halo_data, hrandoms = rng.random(Nhalos), 
+            hveldev = rng.standard_normal(Nhalos, dtype = halo_data['hveldev'].dtype) * halo_data['hsigmav'])
+        particle_data = dict(particle_data, prandoms = rng.random(Nparts))
 
     # find the halos, populate them with galaxies and write them to files
     HOD_dict = gen_gals(halo_data, particle_data, tracers, params, Nthread, enable_ranks, rsd)
@@ -796,6 +789,11 @@ def gen_gal_cat(halo_data, particle_data, tracers, params, Nthread = 16,
             # save to file 
             outdict = HOD_dict[tracer].pop('Ncent', None)
             table = Table(HOD_dict[tracer], meta = {'Ncent': Ncent, 'Gal_type': tracer, **tracers[tracer]})
-            ascii.write(table, outdir / ("%ss.dat"%tracer), overwrite = True, format = 'ecsv')
+            if output_format == 'hdf5':
+                # one binary write of the whole table, no per-value text formatting
+                table.write(outdir / ("%ss.h5"%tracer), path = 'galaxies', overwrite = True, 
+                    serialize_meta = True, compression = 'lzf')
+            else:
+                ascii.write(table, outdir / ("%ss.dat"%tracer), overwrite = True, format = 'ecsv')
 
     return HOD_dict
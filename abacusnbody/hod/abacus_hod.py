@@ -37,14 +37,17 @@ in the catalog are always centrals and the rest are satellites.
 
 The galaxies can be written to disk by setting the 
 ``write_to_disk`` flag to ``True`` in the argument of 
-``run_hod``. However, the I/O is slow and the``write_to_disk`` 
-flag defaults to ``False``.
+``run_hod``, as HDF5 files ``<tracer>s.h5`` by default or as the 
+text files ``<tracer>s.dat`` of earlier versions with 
+``output_format: 'ecsv'`` in the HOD parameters. However, the I/O is 
+slow and the ``write_to_disk`` flag defaults to ``False``.
 
 The core of the AbacusHOD code is a two-pass memory-in-place algorithm.
 The first pass of the halo+particle subsample computes the number
-of galaxies generated in total. Then an empty array for these galaxies 
-is allocated in memory, which is then filled on the second pass of 
-the halos+particles. Each pass is accelerated with numba parallel.
+of galaxies generated in total and records the indices of the halos+particles
+that host them. Then an empty array for these galaxies
+is allocated in memory, which is then filled on the second pass, visiting
+only the recorded halos+particles. Each pass is accelerated with numba parallel.
 The default threading is set to 16. 
 
 
@@ -218,6 +221,7 @@ import argparse
 import multiprocessing
 from multiprocessing import Pool
 from astropy.io import ascii
+from astropy.table import Table
 
 
 from .GRAND_HOD import gen_gal_cat
@@ -247,6 +251,8 @@ class AbacusHOD:
                 * ``subsample_dir``: str, where to save halo+particle subsample, e.g. '/my/output/subsamples/'. 
                 * ``z_mock``: float, which redshift slice, e.g. 0.5.    
                 * ``Nthread_load``: int, how many threads to use to load the simulation data, default 7. 
+                * ``want_float32``: bool, optional, hold positions and velocities in float32, which halves 
+                  the memory traffic of the HOD runs and of the galaxy outputs. Masses stay float64. Default ``False``. 
 
         HOD_params: dict 
             HOD parameters and tracer configurations. Load from ``config/abacus_hod.yaml``. It contains the following keys:
@@ -259,6 +265,7 @@ class AbacusHOD:
                 * ``Ndim``: int, grid density for computing local environment, default 1024.
                 * ``density_sigma``: float, scale radius in Mpc / h for local density definition, default 3.
                 * ``write_to_disk``: bool, output to disk? default ``False``. Setting to ``True`` decreases performance. 
+                * ``output_format``: str, optional, format of the galaxy files written to disk, ``'hdf5'`` (``<tracer>s.h5``) or ``'ecsv'`` (text, ``<tracer>s.dat``). Default ``'hdf5'``; versions up to 0.3.0 always wrote ``'ecsv'``, so set it to ``'ecsv'`` if your scripts read ``<tracer>s.dat``. 
                 * ``LRG_params``: dict, HOD parameter values for LRGs. Default values are given in config file. 
                 * ``ELG_params``: dict, HOD parameter values for ELGs. Default values are given in config file. 
                 * ``QSO_params``: dict, HOD parameter values for QSOs. Default values are given in config file. 
@@ -280,6 +287,7 @@ class AbacusHOD:
         self.subsample_dir = sim_params['subsample_dir']
         self.z_mock = sim_params['z_mock']
         self.scratch_dir = sim_params['scratch_dir']
+        self.want_float32 = sim_params.get('want_float32', False)
         
         # tracers
         tracer_flags = HOD_params['tracer_flags']
@@ -292,6 +300,7 @@ class AbacusHOD:
         # HOD parameter choices
         self.want_ranks = HOD_params['want_ranks']
         self.want_rsd = HOD_params['want_rsd']
+        self.output_format = HOD_params.get('output_format', 'hdf5')
         
         # clusteringparameters
         self.pimax = clustering_params['pimax']
@@ -373,22 +382,25 @@ class AbacusHOD:
         Nhalos_tot = int(np.sum(Nhalos))
         Nparts_tot = int(np.sum(Nparts))
 
-        # list holding individual slabs
-        hpos = np.empty((Nhalos_tot, 3))
-        hvel = np.empty((Nhalos_tot, 3))
+        # list holding individual slabs, positions and velocities are stored
+        # component by component (3, N) so that each component is contiguous
+        pos_dtype = np.float32 if self.want_float32 else np.float64
+        hpos = np.empty((3, Nhalos_tot), dtype = pos_dtype)
+        hvel = np.empty((3, Nhalos_tot), dtype = pos_dtype)
         hmass = np.empty([Nhalos_tot])
-        hid = np.empty([Nhalos_tot], dtype = int)
+        hid = np.empty([Nhalos_tot], dtype = np.int64)
         hmultis = np.empty([Nhalos_tot])
         hrandoms = np.empty([Nhalos_tot])
-        hveldev = np.empty([Nhalos_tot])
+        hveldev = np.empty([Nhalos_tot], dtype = pos_dtype)
+        hsigmav = np.empty([Nhalos_tot], dtype = pos_dtype)
         hdeltac = np.empty([Nhalos_tot])
         hfenv = np.empty([Nhalos_tot])
 
-        ppos = np.empty((Nparts_tot, 3))
-        pvel = np.empty((Nparts_tot, 3))
-        phvel = np.empty((Nparts_tot, 3))
+        ppos = np.empty((3, Nparts_tot), dtype = pos_dtype)
+        pvel = np.empty((3, Nparts_tot), dtype = pos_dtype)
+        phvel = np.empty((3, Nparts_tot), dtype = pos_dtype)
         phmass = np.empty([Nparts_tot])
-        phid = np.empty([Nparts_tot], dtype = int)
+        phid = np.empty([Nparts_tot], dtype = np.int64)
         pNp = np.empty([Nparts_tot])
         psubsampling = np.empty([Nparts_tot])
         prandoms = np.empty([Nparts_tot])
@@ -426,10 +438,11 @@ class AbacusHOD:
             maskedhalos = newfile['halos']
 
             # extracting the halo properties that we need
-            halo_ids = maskedhalos["id"].astype(int) # halo IDs
+            halo_ids = maskedhalos["id"] # halo IDs, cast to int64 on assignment below
             halo_pos = maskedhalos["x_L2com"] # halo positions, Mpc / h
             halo_vels = maskedhalos['v_L2com'] # halo velocities, km/s
             halo_vel_dev = maskedhalos["randoms_gaus_vrms"] # halo velocity dispersions, km/s
+            halo_sigmav = maskedhalos["sigmav3d_L2com"] # 3d velocity dispersion, km/s
             halo_mass = maskedhalos['N']*params['Mpart'] # halo mass, Msun / h, 200b
             halo_deltac = maskedhalos['deltac_rank'] # halo concentration
             halo_fenv = maskedhalos['fenv_rank'] # halo velocities, km/s
@@ -440,13 +453,14 @@ class AbacusHOD:
             halo_randoms = maskedhalos['randoms']
             print("loading halo slab took ", time.time() - start)
 
-            hpos[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_pos
-            hvel[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_vels
+            hpos[:, halo_ticker: halo_ticker + Nhalos[eslab]] = halo_pos.T
+            hvel[:, halo_ticker: halo_ticker + Nhalos[eslab]] = halo_vels.T
             hmass[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_mass
             hid[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_ids
             hmultis[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_multi
             hrandoms[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_randoms
             hveldev[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_vel_dev
+            hsigmav[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_sigmav / np.sqrt(3)
             hdeltac[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_deltac
             hfenv[halo_ticker: halo_ticker + Nhalos[eslab]] = halo_fenv
             halo_ticker += Nhalos[eslab]
@@ -458,7 +472,7 @@ class AbacusHOD:
             part_vel = subsample['vel']
             part_hvel = subsample['halo_vel']
             part_halomass = subsample['halo_mass'] # msun / h
-            part_haloid = subsample['halo_id'].astype(int)
+            part_haloid = subsample['halo_id']
             part_Np = subsample['Np'] # number of particles that end up in the halo
             part_subsample = subsample['downsample_halo']
             part_randoms = subsample['randoms']
@@ -477,9 +491,9 @@ class AbacusHOD:
 
             # #     part_data_slab += [part_ranks, part_ranksv, part_ranksp, part_ranksr]
             # particle_data = vstack([particle_data, new_part_table])
-            ppos[parts_ticker: parts_ticker + Nparts[eslab]] = part_pos
-            pvel[parts_ticker: parts_ticker + Nparts[eslab]] = part_vel
-            phvel[parts_ticker: parts_ticker + Nparts[eslab]] =  part_hvel
+            ppos[:, parts_ticker: parts_ticker + Nparts[eslab]] = part_pos.T
+            pvel[:, parts_ticker: parts_ticker + Nparts[eslab]] = part_vel.T
+            phvel[:, parts_ticker: parts_ticker + Nparts[eslab]] =  part_hvel.T
             phmass[parts_ticker: parts_ticker + Nparts[eslab]] = part_halomass
             phid[parts_ticker: parts_ticker + Nparts[eslab]] =  part_haloid
             pNp[parts_ticker: parts_ticker + Nparts[eslab]] = part_Np
@@ -492,10 +506,12 @@ class AbacusHOD:
         halo_data = {"hpos": hpos, 
                      "hvel": hvel, 
                      "hmass": hmass, 
+                     "hlogm": np.log10(hmass), # fixed across HOD runs, precomputed once
                      "hid": hid, 
                      "hmultis": hmultis, 
                      "hrandoms": hrandoms, 
                      "hveldev": hveldev, 
+                     "hsigmav": hsigmav, # 1d velocity dispersion, to redraw hveldev
                      "hdeltac": hdeltac, 
                      "hfenv": hfenv}
         pweights = 1/pNp/psubsampling
@@ -503,6 +519,7 @@ class AbacusHOD:
                          "pvel": pvel, 
                          "phvel": phvel, 
                          "phmass": phmass, 
+                         "phlogm": np.log10(phmass), 
                          "phid": phid, 
                          "pweights": pweights, 
                          "prandoms": prandoms, 
@@ -522,7 +539,7 @@ class AbacusHOD:
         return halo_data, particle_data, params, mock_dir
 
     
-    def run_hod(self, tracers, want_rsd = True, write_to_disk = False, Nthread = 16):
+    def run_hod(self, tracers, want_rsd = True, write_to_disk = False, Nthread = 16, rng_seed = None):
         """
         Runs a custom HOD.
 
@@ -540,7 +557,13 @@ class AbacusHOD:
             output to disk? default ``False``. Setting to ``True`` decreases performance. 
 
         ``Nthread``: int
-            Number of threads in the HOD run. Default 16. 
+            Number of threads in the HOD run. Default 16. Capped at ``NUMBA_NUM_THREADS``,
+            so the caller's Numba thread pool is never oversubscribed.
+
+        ``rng_seed``: int
+            if given, the random draws of the HOD (halo and particle randoms, central velocity 
+            deviations) are redrawn with this seed, giving a new realization of the mock. 
+            Default ``None`` uses the draws stored with the subsamples. 
 
         Returns
         -------
@@ -556,7 +579,8 @@ class AbacusHOD:
 
         """
         mock_dict = gen_gal_cat(self.halo_data, self.particle_data, self.tracers, self.params, Nthread,
-            enable_ranks = self.want_ranks, rsd = want_rsd, write_to_disk = write_to_disk, savedir = self.mock_dir)
+            enable_ranks = self.want_ranks, rsd = want_rsd, write_to_disk = write_to_disk, savedir = self.mock_dir, 
+            rng_seed = rng_seed, output_format = self.output_format)
 
         return mock_dict
 
@@ -734,7 +758,10 @@ class AbacusHOD:
 
         mockdict = {}
         for tracer in tracers:
-            mockdict[tracer] = ascii.read(outdir/(tracer+'s.dat'))
+            if self.output_format == 'hdf5':
+                mockdict[tracer] = Table.read(outdir/(tracer+'s.h5'), path = 'galaxies')
+            else:
+                mockdict[tracer] = ascii.read(outdir/(tracer+'s.dat'))
         return mockdict
 
 
@@ -11,20 +11,24 @@ import os
 from pathlib import Path
 import yaml
 
+import math
 import numpy as np
 import random
 import time
-from astropy.table import Table
 import h5py
-from scipy.ndimage import gaussian_filter
+from scipy import fft
 from scipy.interpolate import NearestNDInterpolator
 from itertools import repeat
+from functools import partial
 import argparse
 
+import numba
+from numba import njit
+
 from abacusnbody.data.compaso_halo_catalog import CompaSOHaloCatalog
 
 import multiprocessing
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
 
 DEFAULTS = {}
 DEFAULTS['path2config'] = 'config/abacus_hod.yaml'
@@ -47,34 +51,207 @@ def subsample_particles(m, MT):
     else:
         return 4/(200.0 + np.exp(-(x - 13.7)*8)) # LRG only
 
-def get_smo_density_oneslab(i, simdir, simname, z_mock, N_dim):
-    cat = CompaSOHaloCatalog(
-    simdir+simname+'/halos/z'+str(z_mock).ljust(5, '0')+'/halo_info/halo_info_'\
-        +str(i).zfill(3)+'.asdf', fields = ['N', 'x_L2com'])
+def rank_in_groups(values, group, Ngroup):
+    """
+    Ordinal rank of ``values`` within each group, ties ranked in order of appearance, and 
+    the size of the group of each value. ``group`` runs from 0 to ``Ngroup`` - 1.
+    """
+    # one sort by group then value, the rank is the position within the group's segment
+    order = np.lexsort((values, group))
+    counts = np.bincount(group, minlength = Ngroup)
+    seg_start = np.cumsum(counts) - counts
+    ranks = np.empty(len(values), dtype = np.intp)
+    ranks[order] = np.arange(len(values)) - seg_start[group[order]]
+    return ranks, counts[group]
+
+def rank_in_bins(values, bin_id, nbins):
+    """
+    Rank ``values`` within each mass bin and rescale the ranks to [-0.5, 0.5]. Halos 
+    outside the ``nbins`` bins, and lone halos in a bin, get a rank of 0. Tied values are 
+    ranked in halo order, where the former per-bin ``argsort().argsort()`` left them in an 
+    arbitrary order, so tied halos can swap ranks against older subsamples.
+    """
+    rank, n = rank_in_groups(values, bin_id + 1, nbins + 2)
+    norm = n - 1
+    ranks = np.where(norm > 0, rank / np.maximum(norm, 1) - 0.5, 0)
+    ranks[(bin_id < 0) | (bin_id >= nbins)] = 0
+    return ranks
+
+def rank_in_halos(values, halo_of_part, Nhalos):
+    """
+    Rank the particle ``values`` within each halo and rescale the ranks to [-1, 1]. Lone 
+    particles in a halo get a rank of 0.
+    """
+    rank, n = rank_in_groups(values, halo_of_part, Nhalos)
+    # the ordinal ranks 0..n-1 average to (n-1)/2
+    mean_rank = (n - 1) / 2
+    return np.divide(rank - mean_rank, mean_rank, out = np.zeros(len(values), dtype = np.float32), 
+        where = n > 1)
+
+# no nnan/ninf in the fast-math flags and numpy division semantics, degenerate orbits go
+# through nan and are caught by the check at the end
+@njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, error_model='numpy', cache=True)
+def perihelion_rp2(v_tan2, v_rad2, alpha, r0_kpc, rs, num_iters = 20):
+    """
+    Squared perihelion distance of particles on orbits in NFW halos with scale radii ``rs``, 
+    from a fixed-point iteration on x^2 = rp^2 / r0^2. Orbits where the iteration breaks 
+    down get rp = r0.
+    """
+    rp2 = np.empty(len(v_tan2))
+    for i in numba.prange(len(v_tan2)):
+        factorA = v_tan2[i] + v_rad2[i]
+        factorB = math.log1p(r0_kpc[i]/rs[i])
+        x2 = v_tan2[i]/factorA
+        for it in range(num_iters):
+            oldx = math.sqrt(x2)
+            x2 = v_tan2[i]/(factorA + alpha[i]*(math.log1p(oldx*r0_kpc[i]/rs[i])/oldx - factorB))
+        if math.isnan(x2):
+            x2 = 1
+        rp2[i] = r0_kpc[i]**2*x2
+    return rp2
+
+@njit(parallel=True, cache=True)
+def draw_particles(halos_pstart, halos_pnum, mask_halos, subsample_factors, randoms, Npart):
+    """
+    Draw the subsample particles of the kept halos. ``randoms`` holds one uniform draw per 
+    particle of the kept halos, in halo order. Returns the mask over the ``Npart`` particles 
+    and the number of particles kept in each halo.
+    """
+    H = len(halos_pstart)
+    # offset of each kept halo into the random draws
+    roffset = np.zeros(H, dtype = np.int64)
+    Nrand = 0
+    for j in range(H):
+        if mask_halos[j]:
+            roffset[j] = Nrand
+            Nrand += halos_pnum[j]
+    mask_parts = np.zeros(Npart, dtype = np.int8)
+    Nkept = np.zeros(H, dtype = np.int64)
+    for j in numba.prange(H):
+        if mask_halos[j]:
+            # a bernoulli draw with the halo's subsample factor
+            for k in range(halos_pnum[j]):
+                keep = randoms[roffset[j] + k] < subsample_factors[j]
+                mask_parts[halos_pstart[j] + k] = keep
+                Nkept[j] += keep
+    return mask_parts, Nkept
+
+@njit(parallel=True, cache=True)
+def fill_particles(halos_pstart, halos_pnum, halos_pstart_new, halos_pnum_new, mask_parts, 
+    p_halos, halos_mass, halos_v, halos_id, deltac_rank, fenv_rank, idx_parts, 
+    downsample_parts, hvel_parts, Mh_parts, Np_parts, idh_parts, deltach_parts, fenvh_parts):
+    """
+    Gather the subsample particles of each kept halo to ``halos_pstart_new`` onwards and 
+    broadcast the halo properties onto them. ``idx_parts`` receives the index of each 
+    subsample particle in the full particle list.
+    """
+    for j in numba.prange(len(halos_pstart)):
+        if halos_pnum_new[j] <= 0:
+            continue
+        n = halos_pstart_new[j]
+        for k in range(halos_pstart[j], halos_pstart[j] + halos_pnum[j]):
+            if mask_parts[k]:
+                idx_parts[n] = k
+                downsample_parts[n] = p_halos[j]
+                hvel_parts[n, 0] = halos_v[j, 0]
+                hvel_parts[n, 1] = halos_v[j, 1]
+                hvel_parts[n, 2] = halos_v[j, 2]
+                Mh_parts[n] = halos_mass[j] # in msun / h
+                Np_parts[n] = halos_pnum_new[j]
+                idh_parts[n] = halos_id[j]
+                deltach_parts[n] = deltac_rank[j]
+                fenvh_parts[n] = fenv_rank[j]
+                n += 1
+
+def cell_index(pos, Lbox, N_dim):
+    """
+    Flattened index of the density grid cell holding each position. The cells are uniform 
+    so the index follows from the position without a search over the cell edges, positions 
+    on the upper box edge go to the last cell.
+    """
+    ixs = np.asarray(pos, dtype = np.float64) + Lbox/2
+    ixs *= N_dim/Lbox
+    ixs = np.floor(ixs, out = ixs).astype(np.intp)
+    np.clip(ixs, 0, N_dim - 1, out = ixs)
+    return (ixs[:, 0]*N_dim + ixs[:, 1])*N_dim + ixs[:, 2]
+
+def get_smo_density_oneslab(halo_info_fn, N_dim):
+    cat = CompaSOHaloCatalog(halo_info_fn, fields = ['N', 'x_L2com'])
     Lbox = cat.header['BoxSizeHMpc']
     halos = cat.halos
       
     # total number of objects                                                                                                      
     N_g = np.sum(halos['N'])   
-    # get a 3d histogram with number of objects in each cell                                                                       
-    D, edges = np.histogramdd(halos['x_L2com'], weights = halos['N'],
-        bins = N_dim, range = [[-Lbox/2, Lbox/2],[-Lbox/2, Lbox/2],[-Lbox/2, Lbox/2]])   
+    # get a 3d histogram with number of objects in each cell
+    D = np.bincount(cell_index(halos['x_L2com'], Lbox, N_dim), weights = halos['N'], 
+        minlength = N_dim**3).reshape(N_dim, N_dim, N_dim)
     return D
 
 
-def get_smo_density(smo_scale, numslabs, simdir, simname, z_mock, N_dim):   
-    Dtot = 0
-    for i in range(numslabs):
-        Dtot += get_smo_density_oneslab(i, simdir, simname, z_mock, N_dim)   
+def gaussian_kernel_periodic(sigma, N_dim, truncate = 4.0):
+    """
+    The sampled, truncated and normalized 1D gaussian that ``scipy.ndimage.gaussian_filter`` 
+    convolves with, wrapped onto a periodic grid of ``N_dim`` cells.
+    """
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    weights = np.exp(-0.5 * (x / sigma)**2)
+    kernel = np.zeros(N_dim)
+    np.add.at(kernel, x % N_dim, weights / np.sum(weights))
+    return kernel
+
+def get_smo_density_slabs(halo_info_fns, N_dim):
+    # sum the slabs in the worker so that only one grid per worker is sent back
+    D = 0
+    for halo_info_fn in halo_info_fns:
+        D += get_smo_density_oneslab(halo_info_fn, N_dim)
+    return D
 
-    # gaussian smoothing 
-    Dtot = gaussian_filter(Dtot, sigma = smo_scale, mode = "wrap")
+def get_smo_density(smo_scale, halo_info_fns, N_dim, Nthread = 1):   
+    # deal the slabs out to the workers
+    slabs = [halo_info_fns[k::Nthread] for k in range(min(Nthread, len(halo_info_fns)))]
+    if len(slabs) > 1:
+        Dtot = 0
+        with Pool(len(slabs)) as p:
+            for D in p.imap_unordered(partial(get_smo_density_slabs, N_dim = N_dim), slabs):
+                Dtot += D
+    else:
+        Dtot = get_smo_density_slabs(halo_info_fns, N_dim)
+
+    # gaussian smoothing with periodic boundaries, same as gaussian_filter(mode = "wrap") but 
+    # as a product of the separable 1D kernels in Fourier space
+    if smo_scale > 0:
+        kernel = gaussian_kernel_periodic(smo_scale, N_dim)
+        # the kernel is symmetric so its transform is real
+        Dk = fft.rfftn(Dtot, workers = Nthread)
+        Dk *= fft.fft(kernel).real[:, None, None]
+        Dk *= fft.fft(kernel).real[None, :, None]
+        Dk *= fft.rfft(kernel).real[None, None, :]
+        Dtot = fft.irfftn(Dk, s = Dtot.shape, workers = Nthread)
+        del Dk
 
     # average number of particles per cell                                                                                         
     D_avg = np.sum(Dtot)/N_dim**3                                                                                                                                                                                                                              
     return Dtot / D_avg - 1
 
-def prepare_slab(i, savedir, simdir, simname, z_mock, tracer_flags, MT, want_ranks, N_dim, newseed):
+def write_columns(filename, name, columns):
+    """
+    Write a dict of equal-length column arrays to ``filename`` as the structured dataset 
+    ``name``, replacing the file if it exists.
+    """
+    N = len(next(iter(columns.values())))
+    data = np.empty(N, dtype = [(col, arr.dtype, arr.shape[1:]) for col, arr in columns.items()])
+    for col, arr in columns.items():
+        data[col] = arr
+    if os.path.exists(filename):
+        os.remove(filename)
+    # chunked with lzf and byte shuffling, cheap to decode and well suited to float columns
+    with h5py.File(filename, 'w') as newfile:
+        newfile.create_dataset(name, data = data, chunks = (min(65536, max(N, 1)),), 
+            maxshape = (None,), compression = 'lzf', shuffle = True)
+
+def prepare_slab(i, halo_info_fn, savedir, tracer_flags, MT, want_ranks, N_dim, newseed, 
+    dens_grid_shm = None):
     outfilename_halos = savedir+'/halos_xcom_'+str(i)+'_seed'+str(newseed)+'_abacushod'
     outfilename_particles = savedir+'/particles_xcom_'+str(i)+'_seed'+str(newseed)+'_abacushod'
     if MT:
@@ -85,7 +262,9 @@ def prepare_slab(i, savedir, simdir, simname, z_mock, tracer_flags, MT, want_ran
     outfilename_particles += '_new.h5'
     outfilename_halos += '_new.h5'
 
-    np.random.seed(newseed + i)
+    # an independent stream per slab, the same as SeedSequence(newseed).spawn(numslabs)[i] so 
+    # that the draws do not depend on which worker runs the slab
+    rng = np.random.default_rng(np.random.SeedSequence(newseed, spawn_key = (i,)))
     # # if file already exists, just skip
     # if os.path.exists(outfilename_halos) \
     # and os.path.exists(outfilename_particles):
@@ -94,238 +273,180 @@ def prepare_slab(i, savedir, simdir, simname, z_mock, tracer_flags, MT, want_ran
     # load the halo catalog slab
     print("loading halo catalog ")
     start = time.time()
-    cat = CompaSOHaloCatalog(
-        simdir+simname+'/halos/z'+str(z_mock).ljust(5, '0')+'/halo_info/halo_info_'\
-        +str(i).zfill(3)+'.asdf', load_subsamples = 'A_halo_rv', fields = ['N', 
+    # only the fields used below are read. the catalog cannot read the subsamples of a subset 
+    # of halos, so all of A_halo_rv is loaded and cut down to the kept halos further on
+    cat = CompaSOHaloCatalog(halo_info_fn, load_subsamples = 'A_halo_rv', fields = ['N', 
         'x_L2com', 'v_L2com', 'r90_L2com', 'r25_L2com', 'npstartA', 'npoutA', 'id', 'sigmav3d_L2com'])
-    halos = cat.halos
-    parts = cat.subsamples
+    # plain arrays, the new columns are added as we go and the tables are only built for output
+    halos = {name: np.asarray(cat.halos[name]) for name in cat.halos.colnames}
+    parts = {name: np.asarray(cat.subsamples[name]) for name in cat.subsamples.colnames}
     header = cat.header
-    Lbox = cat.header['BoxSizeHMpc']
+    # drop the catalog so that the full subsample is freed once it is cut down
+    del cat
+    Nhalos = len(halos['N'])
+    Lbox = header['BoxSizeHMpc']
     Mpart = header['ParticleMassHMsun'] # msun / h 
     H0 = header['H0']
     h = H0/100.0
     print("finished loading halo catalog", time.time() - start)
-    print("number of halos ", len(halos), "max halo mass", np.max(halos['N']) * Mpart,
+    print("number of halos ", Nhalos, "max halo mass", np.max(halos['N']) * Mpart,
         "min halo mass", np.min(halos['N']) * Mpart, "particle mass ", Mpart)
     # # form a halo table of the columns i care about 
     # creating a mask of which halos to keep, which halos to drop
     p_halos = subsample_halos(halos['N']*Mpart, MT)
-    mask_halos = np.random.random(len(halos)) < p_halos
-    print("total number of halos, ", len(halos), "keeping ", np.sum(mask_halos))
+    mask_halos = rng.random(Nhalos) < p_halos
+    print("total number of halos, ", Nhalos, "keeping ", np.sum(mask_halos))
 
     halos['mask_subsample'] = mask_halos
     halos['multi_halos'] = 1.0 / p_halos
 
     nbins = 100
     mbins = np.logspace(np.log10(3e10), 15.5, nbins + 1)
+    # mass bin of every halo, -1 and nbins for halos below and above the binned range
+    bin_id = np.digitize(halos['N']*Mpart, mbins) - 1
 
     print("computing density rank")
     start = time.time()
-    dens_grid = np.array(h5py.File(savedir+"/density_field.h5", 'r')['dens'])
-    ixs = np.floor((np.array(halos['x_L2com']) + Lbox/2) / (Lbox/N_dim)).astype(np.int) % N_dim
-    halos_overdens = dens_grid[ixs[:, 0], ixs[:, 1], ixs[:, 2]]
+    # map the grid shared by the parent process if there is one, else read it from disk
+    if dens_grid_shm is None:
+        with h5py.File(savedir+"/density_field.h5", 'r') as densfile:
+            dens_grid = densfile['dens'][()]
+    else:
+        shm_name, shape, dtype = dens_grid_shm
+        shm = shared_memory.SharedMemory(name = shm_name)
+        dens_grid = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+    halos_overdens = dens_grid.ravel()[cell_index(halos['x_L2com'], Lbox, N_dim)]
+    del dens_grid
+    if dens_grid_shm is not None:
+        shm.close()
     print("done overdensity array")
-    fenv_rank = np.zeros(len(halos))
-    for ibin in range(nbins):
-        mmask = (halos['N']*Mpart > mbins[ibin]) & (halos['N']*Mpart < mbins[ibin + 1])
-        if np.sum(mmask) > 0:
-            if np.sum(mmask) == 1:
-                fenv_rank[mmask] = 0
-            else:
-                new_fenv_rank = halos_overdens[mmask].argsort().argsort()
-                fenv_rank[mmask] = new_fenv_rank / np.max(new_fenv_rank) - 0.5
+    fenv_rank = rank_in_bins(halos_overdens, bin_id, nbins)
     halos['fenv_rank'] = fenv_rank
     print("finished density rank", time.time() - start)
 
     # compute delta concentration
     print("computing c rank")
     start = time.time()
-    halos_c = halos['r90_L2com']/halos['r25_L2com']
-    deltac_rank = np.zeros(len(halos))
-    for ibin in range(nbins):
-        mmask = (halos['N']*Mpart > mbins[ibin]) & (halos['N']*Mpart < mbins[ibin + 1])
-        if np.sum(mmask) > 0:
-            if np.sum(mmask) == 1:
-                deltac_rank[mmask] = 0
-            else:
-                new_deltac = halos_c[mmask] - np.median(halos_c[mmask])
-                new_deltac_rank = new_deltac.argsort().argsort()
-                deltac_rank[mmask] = new_deltac_rank / np.max(new_deltac_rank) - 0.5
+    # ranking c - median(c) within a bin is the same as ranking c, the median only shifts it
+    halos_c = np.asarray(halos['r90_L2com']/halos['r25_L2com'])
+    deltac_rank = rank_in_bins(halos_c, bin_id, nbins)
     halos['deltac_rank'] = deltac_rank
     print("finished delta c", time.time() - start)
 
-    # the new particle start, len, and multiplier
-    halos_pstart = halos['npstartA']
-    halos_pnum = halos['npoutA']
-    halos_pstart_new = np.zeros(len(halos))
-    halos_pnum_new = np.zeros(len(halos))
-
-    # particle arrays for ranks and mask 
-    mask_parts = np.zeros(len(parts))
-    len_old = len(parts)
-    ranks_parts = np.full(len_old, -1.0)
-    ranksv_parts = np.full(len_old, -1.0)
-    ranksr_parts = np.full(len_old, -1.0)
-    ranksp_parts = np.full(len_old, -1.0)
-    pos_parts = np.full((len_old, 3), -1.0)
-    vel_parts = np.full((len_old, 3), -1.0)
-    hvel_parts = np.full((len_old, 3), -1.0)
-    Mh_parts = np.full(len_old, -1.0)
-    Np_parts = np.full(len_old, -1.0)
-    downsample_parts = np.full(len_old, -1.0)
-    idh_parts = np.full(len_old, -1.0)
-    deltach_parts = np.full(len_old, -1.0)
-    fenvh_parts = np.full(len_old, -1.0)
+    # the new particle start, len, and multiplier, as plain arrays for the numba kernels
+    halos_pstart = np.asarray(halos['npstartA'], dtype = np.int64)
+    halos_pnum = np.asarray(halos['npoutA'], dtype = np.int64)
+    halos_mass = halos['N']*Mpart # in msun / h
 
     print("compiling particle subsamples")
-    start_tracker = 0
-    for j in np.arange(len(halos)):
-        if j % 10000 == 0:
-            print("halo id", j, end = '\r')
-        if mask_halos[j]:
-            # updating the mask tagging the particles we want to preserve
-            subsample_factor = subsample_particles(halos['N'][j] * Mpart, MT)
-            submask = np.random.binomial(n = 1, p = subsample_factor, size = halos_pnum[j])
-            # updating the particles' masks, downsample factors, halo mass
-            mask_parts[halos_pstart[j]: halos_pstart[j] + halos_pnum[j]] = submask
-            # print(j, halos_pstart, halos_pnum, p_halos, downsample_parts)
-            downsample_parts[halos_pstart[j]: halos_pstart[j] + halos_pnum[j]] = p_halos[j]
-            hvel_parts[halos_pstart[j]: halos_pstart[j] + halos_pnum[j]] = halos['v_L2com'][j]
-            Mh_parts[halos_pstart[j]: halos_pstart[j] + halos_pnum[j]] = halos['N'][j] * Mpart # in msun / h
-            Np_parts[halos_pstart[j]: halos_pstart[j] + halos_pnum[j]] = np.sum(submask)
-            idh_parts[halos_pstart[j]: halos_pstart[j] + halos_pnum[j]] = halos['id'][j]
-            deltach_parts[halos_pstart[j]: halos_pstart[j] + halos_pnum[j]] = deltac_rank[j]
-            fenvh_parts[halos_pstart[j]: halos_pstart[j] + halos_pnum[j]] = fenv_rank[j]
-
-            # updating the pstart, pnum, for the halos
-            halos_pstart_new[j] = start_tracker
-            halos_pnum_new[j] = np.sum(submask)
-            start_tracker += np.sum(submask)
-
-            if want_ranks:
-                if np.sum(submask) == 0:
-                    continue
-                # extract particle index
-                indices_parts = np.arange(
-                    halos_pstart[j], halos_pstart[j] + halos_pnum[j])[submask.astype(bool)]
-                indices_parts = indices_parts.astype(int)
-                if np.sum(submask) == 1:
-                    ranks_parts[indices_parts] = 0
-                    ranksv_parts[indices_parts] = 0
-                    ranksp_parts[indices_parts] = 0
-                    ranksr_parts[indices_parts] = 0
-                    continue
-                
-                # make the rankings
-                theseparts = parts[
-                    halos_pstart[j]: halos_pstart[j] + halos_pnum[j]][submask.astype(bool)]
-                theseparts_pos = theseparts['pos']
-                theseparts_vel = theseparts['vel']
-                theseparts_halo_pos = halos['x_L2com'][j]
-                theseparts_halo_vel = halos['v_L2com'][j]
-
-                dist2_rel = np.sum((theseparts_pos - theseparts_halo_pos)**2, axis = 1)
-                newranks = dist2_rel.argsort().argsort() 
-                ranks_parts[indices_parts] = (newranks - np.mean(newranks)) / np.mean(newranks)
-
-                v2_rel = np.sum((theseparts_vel - theseparts_halo_vel)**2, axis = 1)
-                newranksv = v2_rel.argsort().argsort() 
-                ranksv_parts[indices_parts] = (newranksv - np.mean(newranksv)) / np.mean(newranksv)
-
-                # get rps
-                # calc relative positions
-                r_rel = theseparts_pos - theseparts_halo_pos 
-                r0 = np.sqrt(np.sum(r_rel**2, axis = 1))
-                r_rel_norm = r_rel/r0[:, None]
-
-                # list of peculiar velocities of the particles
-                vels_rel = theseparts_vel - theseparts_halo_vel # velocity km/s
-                # relative speed to halo center squared
-                v_rel2 = np.sum(vels_rel**2, axis = 1) 
-
-                # calculate radial and tangential peculiar velocity
-                vel_rad = np.sum(vels_rel*r_rel_norm, axis = 1)
-                newranksr = vel_rad.argsort().argsort() 
-                ranksr_parts[indices_parts] = (newranksr - np.mean(newranksr)) / np.mean(newranksr)
-
-                # radial component
-                v_rad2 = vel_rad**2 # speed
-                # tangential component
-                v_tan2 = v_rel2 - v_rad2
-
-                # compute the perihelion distance for NFW profile
-                m = halos['N'][j]*Mpart / h # in kg
-                rs = halos['r25_L2com'][j]
-                c = halos['r90_L2com'][j]/rs
-                r0_kpc = r0*1000 # kpc
-                alpha = 1.0/(np.log(1+c)-c/(1+c))*2*6.67e-11*m*2e30/r0_kpc/3.086e+19/1e6
-
-                # iterate a few times to solve for rp
-                x2 = v_tan2/(v_tan2+v_rad2)
-
-                num_iters = 20 # how many iterations do we want
-                factorA = v_tan2 + v_rad2
-                factorB = np.log(1+r0_kpc/rs)
-                for it in range(num_iters):
-                    oldx = np.sqrt(x2)
-                    x2 = v_tan2/(factorA + alpha*(np.log(1+oldx*r0_kpc/rs)/oldx - factorB))
-                x2[np.isnan(x2)] = 1
-                # final perihelion distance 
-                rp2 = r0_kpc**2*x2
-                newranksp = rp2.argsort().argsort() 
-                ranksp_parts[indices_parts] = (newranksp - np.mean(newranksp)) / np.mean(newranksp)
-
-        else:
-            halos_pstart_new[j] = -1
-            halos_pnum_new[j] = -1
+    # one batched draw for the particles of the kept halos, in halo order
+    halos_kept = np.flatnonzero(mask_halos)
+    len_old = len(parts['pos'])
+    randoms_parts = rng.random(np.sum(halos_pnum[halos_kept]))
+    mask_parts, Nkept = draw_particles(halos_pstart, halos_pnum, np.asarray(mask_halos), 
+        subsample_particles(halos_mass, MT), randoms_parts, len_old)
+    del randoms_parts
+    halos_pstart_new = np.where(mask_halos, np.cumsum(Nkept) - Nkept, -1)
+    halos_pnum_new = np.where(mask_halos, Nkept, -1)
+
+    # particle arrays allocated at the subsample length, filled in halo order. velocities and 
+    # ranks are stored in single precision, the halo velocities are float32 to begin with
+    len_new = np.sum(Nkept)
+    idx_parts = np.empty(len_new, dtype = np.int64)
+    hvel_parts = np.empty((len_new, 3), dtype = np.float32)
+    Mh_parts = np.empty(len_new)
+    Np_parts = np.empty(len_new, dtype = np.int32)
+    downsample_parts = np.empty(len_new)
+    idh_parts = np.empty(len_new, dtype = np.int64) # integer, float64 would round ids above 2**53
+    deltach_parts = np.empty(len_new, dtype = np.float32)
+    fenvh_parts = np.empty(len_new, dtype = np.float32)
+    fill_particles(halos_pstart, halos_pnum, halos_pstart_new, halos_pnum_new, mask_parts, 
+        np.asarray(p_halos, dtype = np.float64), halos_mass, 
+        np.asarray(halos['v_L2com'], dtype = np.float32), 
+        np.asarray(halos['id'], dtype = np.int64), deltac_rank, fenv_rank, idx_parts, 
+        downsample_parts, hvel_parts, Mh_parts, Np_parts, idh_parts, deltach_parts, fenvh_parts)
+    del mask_parts
+    parts = {name: col[idx_parts] for name, col in parts.items()}
 
-    halos['npstartA'] = halos_pstart_new
-    halos['npoutA'] = halos_pnum_new
-    halos['randoms'] = np.random.random(len(halos)) # attaching random numbers
-    halos['randoms_gaus_vrms'] = np.random.normal(loc = 0, 
-        scale = halos["sigmav3d_L2com"]/np.sqrt(3), size = len(halos)) # attaching random numbers
+    if want_ranks:
+        print("computing particle ranks")
+        start = time.time()
+        # all halos at once, the subsample particles are grouped by halo
+        halo_of_part = np.repeat(np.arange(Nhalos), Nkept)
+        # calc relative positions
+        r_rel = parts['pos'] - halos['x_L2com'][halo_of_part]
+        dist2_rel = np.sum(r_rel**2, axis = 1)
+        ranks_parts = rank_in_halos(dist2_rel, halo_of_part, Nhalos)
+
+        # list of peculiar velocities of the particles
+        vels_rel = parts['vel'] - halos['v_L2com'][halo_of_part] # velocity km/s
+        # relative speed to halo center squared
+        v_rel2 = np.sum(vels_rel**2, axis = 1) 
+        ranksv_parts = rank_in_halos(v_rel2, halo_of_part, Nhalos)
+
+        # calculate radial and tangential peculiar velocity
+        r0 = np.sqrt(dist2_rel)
+        r_rel_norm = r_rel/r0[:, None]
+        vel_rad = np.sum(vels_rel*r_rel_norm, axis = 1)
+        ranksr_parts = rank_in_halos(vel_rad, halo_of_part, Nhalos)
+        del r_rel, vels_rel, r_rel_norm
+
+        # radial component
+        v_rad2 = vel_rad**2 # speed
+        # tangential component
+        v_tan2 = v_rel2 - v_rad2
+
+        # compute the perihelion distance for NFW profile
+        m = halos_mass / h # in kg
+        rs = halos['r25_L2com']
+        c = (halos['r90_L2com']/rs).astype(np.float64)
+        r0_kpc = r0*1000 # kpc
+        # rounded to float32 on purpose, the precision the per-halo loop computed it at
+        nfw_fac = (1.0/(np.log(1+c)-c/(1+c))*2*6.67e-11*m*2e30).astype(np.float32)
+        alpha = nfw_fac[halo_of_part]/r0_kpc/3.086e+19/1e6
+
+        # iterate a few times to solve for rp, final perihelion distance
+        rp2 = perihelion_rp2(v_tan2, v_rad2, alpha, r0_kpc, rs[halo_of_part])
+        ranksp_parts = rank_in_halos(rp2, halo_of_part, Nhalos)
+        print("finished particle ranks", time.time() - start)
+
+    halos['npstartA'] = halos_pstart_new.astype(np.float64)
+    halos['npoutA'] = halos_pnum_new.astype(np.float64)
+    halos['randoms'] = rng.random(Nhalos) # attaching random numbers
+    halos['randoms_gaus_vrms'] = rng.normal(loc = 0, 
+        scale = halos["sigmav3d_L2com"]/np.sqrt(3), size = Nhalos) # attaching random numbers
 
     # output halo file 
     print("outputting new halo file ")
     # output_dir = savedir+'/halos_xcom_'+str(i)+'_seed'+str(newseed)+'_abacushodMT_new.h5'
-    if os.path.exists(outfilename_halos):
-        os.remove(outfilename_halos)
     print(outfilename_halos, outfilename_particles)
-    newfile = h5py.File(outfilename_halos, 'w')
-    dataset = newfile.create_dataset('halos', data = halos[mask_halos])
-    newfile.close()
+    write_columns(outfilename_halos, 'halos', 
+        {name: col[mask_halos] for name, col in halos.items()})
 
     # output the new particle file
     print("adding rank fields to particle data ")
-    mask_parts = mask_parts.astype(bool)
-    parts = parts[mask_parts]
-    print("pre process particle number ", len_old, " post process particle number ", len(parts))
+    print("pre process particle number ", len_old, " post process particle number ", len_new)
     if want_ranks:
-        parts['ranks'] = ranks_parts[mask_parts]
-        parts['ranksv'] = ranksv_parts[mask_parts]
-        parts['ranksr'] = ranksr_parts[mask_parts]
-        parts['ranksp'] = ranksp_parts[mask_parts]
-    parts['downsample_halo'] = downsample_parts[mask_parts]
-    parts['halo_vel'] = hvel_parts[mask_parts]
-    parts['halo_mass'] = Mh_parts[mask_parts]
-    parts['Np'] = Np_parts[mask_parts]
-    parts['halo_id'] = idh_parts[mask_parts]
-    parts['randoms'] = np.random.random(len(parts))
-    parts['halo_deltac'] = deltach_parts[mask_parts]
-    parts['halo_fenv'] = fenvh_parts[mask_parts]
+        parts['ranks'] = ranks_parts
+        parts['ranksv'] = ranksv_parts
+        parts['ranksr'] = ranksr_parts
+        parts['ranksp'] = ranksp_parts
+    parts['downsample_halo'] = downsample_parts
+    parts['halo_vel'] = hvel_parts
+    parts['halo_mass'] = Mh_parts
+    parts['Np'] = Np_parts
+    parts['halo_id'] = idh_parts
+    parts['randoms'] = rng.random(len_new)
+    parts['halo_deltac'] = deltach_parts
+    parts['halo_fenv'] = fenvh_parts
 
     print("are there any negative particle values? ", np.sum(parts['downsample_halo'] < 0), 
         np.sum(parts['halo_mass'] < 0))
     print("outputting new particle file ")
     # output_dir = savedir+'/particles_xcom_'+str(i)+'_seed'+str(newseed)+'_abacushodMT_new.h5'
-    if os.path.exists(outfilename_particles):
-        os.remove(outfilename_particles)
-    newfile = h5py.File(outfilename_particles, 'w')
-    dataset = newfile.create_dataset('particles', data = parts)
-    newfile.close()
+    write_columns(outfilename_particles, 'particles', parts)
 
-    print("pre process particle number ", len_old, " post process particle number ", len(parts))
+    print("pre process particle number ", len_old, " post process particle number ", len_new)
 
 def main(path2config, params = None):
     config = yaml.load(open(path2config))
@@ -339,8 +460,9 @@ def main(path2config, params = None):
     z_mock = config['sim_params']['z_mock']
     savedir = config['sim_params']['subsample_dir']+simname+"/z"+str(z_mock).ljust(5, '0') 
 
-    halo_info_fns = \
-    list((Path(simdir) / Path(simname) / 'halos' / ('z%4.3f'%z_mock) / 'halo_info').glob('*.asdf'))
+    # the slab files, listed once and handed to the workers
+    halo_info_fns = [str(fn) for fn in sorted((Path(simdir) / simname / 'halos' / ('z%4.3f'%z_mock) 
+        / 'halo_info').glob('halo_info_*.asdf'))]
     numslabs = len(halo_info_fns)
 
     tracer_flags = config['HOD_params']['tracer_flags']
@@ -357,20 +479,40 @@ def main(path2config, params = None):
     start = time.time()
     if not os.path.exists(savedir+"/density_field.h5"):
         dens_grid = get_smo_density(config['HOD_params']['density_sigma'],
-             numslabs, simdir, simname, z_mock, N_dim)
+             halo_info_fns, N_dim, config['sim_params']['Nthread_load'])
         print("Generating density field took ", time.time() - start)
         # np.savez(savedir+"/density_field", dens = dens_grid)
         newfile = h5py.File(savedir+"/density_field.h5", 'w')
         dataset = newfile.create_dataset('dens', data = dens_grid)
         newfile.close()
+    else:
+        with h5py.File(savedir+"/density_field.h5", 'r') as densfile:
+            dens_grid = densfile['dens'][()]
+
+    # hold the density grid in shared memory so the workers map it instead of each reading it
+    shm = shared_memory.SharedMemory(create = True, size = dens_grid.nbytes)
+    shared_grid = np.ndarray(dens_grid.shape, dtype = dens_grid.dtype, buffer = shm.buf)
+    shared_grid[...] = dens_grid
+    dens_grid_shm = (shm.name, dens_grid.shape, dens_grid.dtype.str)
+    del shared_grid, dens_grid
 
-    p = multiprocessing.Pool(config['sim_params']['Nthread_load'])
-    p.starmap(prepare_slab, zip(range(numslabs), repeat(savedir), 
-        repeat(simdir), repeat(simname), repeat(z_mock), 
+    slab_args = list(zip(range(numslabs), halo_info_fns, repeat(savedir), 
         repeat(tracer_flags), repeat(MT), repeat(want_ranks), 
-        repeat(N_dim), repeat(newseed)))
-    p.close()
-    p.join()
+        repeat(N_dim), repeat(newseed), repeat(dens_grid_shm)))
+    # every slab is processed exactly once, in the pool if there is more than one worker
+    Nthread_load = min(config['sim_params']['Nthread_load'], numslabs)
+    try:
+        if Nthread_load > 1:
+            p = multiprocessing.Pool(Nthread_load)
+            p.starmap(prepare_slab, slab_args)
+            p.close()
+            p.join()
+        else:
+            for args in slab_args:
+                prepare_slab(*args)
+    finally:
+        shm.close()
+        shm.unlink()
 
     print("done, took time ", time.time() - start)
 
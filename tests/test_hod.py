@@ -27,6 +27,18 @@ EXAMPLE_GALS = os.path.join(os.path.dirname(__file__),
     'data_mocks_summit_new/Mini_N64_L32/z0.000/galaxies_rsd/LRGs.dat')
 path2config = os.path.join(os.path.dirname(__file__), 'abacus_hod.yaml')
 
+def compare_subsample(new, ref):
+    '''Compare two subsample tables column by column, floats to the precision they are stored in
+    '''
+    assert new.dtype == ref.dtype and len(new) == len(ref)
+    for name in ref.dtype.names:
+        if np.issubdtype(ref.dtype[name].base, np.floating):
+            # the float32 columns only hold about 7 significant digits
+            tol = 1e-6 if ref.dtype[name].base == np.float32 else 1e-12
+            assert np.allclose(new[name], ref[name], rtol = tol, atol = tol, equal_nan = True), name
+        else:
+            assert np.array_equal(new[name], ref[name]), name
+
 def test_hod(tmp_path, reference_mode = False):
     '''Test loading a halo catalog
     '''
@@ -51,7 +63,8 @@ def test_hod(tmp_path, reference_mode = False):
         pimax = clustering_params['pimax']
         pi_bin_size = clustering_params['pi_bin_size']
         
-        # create a new abacushod object
+        # create a new abacushod object, the reference galaxies are kept as text
+        HOD_params['output_format'] = 'ecsv'
         newBall = AbacusHOD(sim_params, HOD_params, clustering_params)
         mock_dict = newBall.run_hod(newBall.tracers, want_rsd, write_to_disk = True, Nthread = 2)
 
@@ -72,16 +85,12 @@ def test_hod(tmp_path, reference_mode = False):
         # check subsample file match
         prepare_sim.main(EXAMPLE_CONFIG, params = config)
 
-        newhalos = h5py.File(savedir+'/halos_xcom_2_seed600_abacushod_new.h5', 'r')['halos']
-        temphalos = h5py.File(EXAMPLE_SUBSAMPLE_HALOS, 'r')['halos']
-        for i in range(len(newhalos)):
-            for j in range(len(newhalos[i])):
-                assert np.array_equal(newhalos[i][j], temphalos[i][j])
-        newparticles = h5py.File(savedir+'/particles_xcom_2_seed600_abacushod_new.h5', 'r')['particles']
-        tempparticles = h5py.File(EXAMPLE_SUBSAMPLE_PARTS, 'r')['particles']
-        for i in range(len(newparticles)):
-            for j in range(len(newparticles[i])):
-                assert np.array_equal(newparticles[i][j], tempparticles[i][j])
+        newhalos = h5py.File(savedir+'/halos_xcom_2_seed600_abacushod_new.h5', 'r')['halos'][()]
+        temphalos = h5py.File(EXAMPLE_SUBSAMPLE_HALOS, 'r')['halos'][()]
+        compare_subsample(newhalos, temphalos)
+        newparticles = h5py.File(savedir+'/particles_xcom_2_seed600_abacushod_new.h5', 'r')['particles'][()]
+        tempparticles = h5py.File(EXAMPLE_SUBSAMPLE_PARTS, 'r')['particles'][()]
+        compare_subsample(newparticles, tempparticles)
 
         # additional parameter choices
         want_rsd = HOD_params['want_rsd']
@@ -97,11 +106,253 @@ def test_hod(tmp_path, reference_mode = False):
         # throw away run for jit to compile, write to disk
         mock_dict = newBall.run_hod(newBall.tracers, want_rsd, write_to_disk = True, Nthread = 2)
         savedir_gal = config['sim_params']['scratch_dir']\
-        +"/"+simname+"/z"+str(z_mock).ljust(5, '0') +"/galaxies_rsd/LRGs.dat"
+        +"/"+simname+"/z"+str(z_mock).ljust(5, '0') +"/galaxies_rsd/LRGs.h5"
         data = ascii.read(EXAMPLE_GALS)
-        data1 = ascii.read(savedir_gal)
+        data1 = h5py.File(savedir_gal, 'r')['galaxies'][()]
         for ekey in data.keys():
             assert np.allclose(data[ekey], data1[ekey])
 
+def test_erf_fast():
+    '''Test the polynomial error functions of the HOD against the math module
+    '''
+    import math
+    from abacusnbody.hod.GRAND_HOD import erfc_fast, erf_fast
+
+    for x in np.linspace(-8, 8, 16001):
+        assert abs(erfc_fast(x) - math.erfc(x)) < 2e-7
+        assert abs(erf_fast(x) - math.erf(x)) < 2e-7
+
+def test_hod_counts_erf_fast():
+    '''Test that the galaxy counts of the HOD functions agree with the exact error function
+    '''
+    from scipy.special import erf, erfc
+    from abacusnbody.hod.GRAND_HOD import n_cen_LRG, n_sat_LRG_modified, N_cen_ELG_v1, N_cen_QSO
+
+    with open(EXAMPLE_CONFIG) as f:
+        HOD_params = yaml.safe_load(f)['HOD_params']
+    L, E, Q = HOD_params['LRG_params'], HOD_params['ELG_params'], HOD_params['QSO_params']
+
+    # a catalog of halos with the same randoms for both versions
+    rng = np.random.default_rng(300)
+    Nhalos = 200000
+    logM = rng.uniform(11., 15., Nhalos)
+    M = 10**logM
+    randoms = rng.random(Nhalos)
+
+    M_cut, M_1 = 10**L['logM_cut'], 10**L['logM1']
+    probs = {
+        'LRG': (np.vectorize(n_cen_LRG)(logM, L['logM_cut'], L['sigma']), 
+            0.5*erfc((L['logM_cut'] - logM)/(np.sqrt(2)*L['sigma']))), 
+        'ELG': (np.vectorize(N_cen_ELG_v1)(logM, E['p_max'], E['Q'], E['logM_cut'], E['sigma'], E['gamma']), 
+            2*(E['p_max'] - 1/E['Q'])*np.exp(-((logM - E['logM_cut'])/E['sigma'])**2/2)/np.sqrt(2*np.pi)/E['sigma']
+            *0.5*(1 + erf(E['gamma']*(logM - E['logM_cut'])/E['sigma']/np.sqrt(2))) 
+            + 0.5/E['Q']*(1 + erf((logM - E['logM_cut'])*100))), 
+        'QSO': (np.vectorize(N_cen_QSO)(logM, Q['p_max'], Q['logM_cut'], Q['sigma']), 
+            0.5*Q['p_max']*(1 + erf((logM - Q['logM_cut'])/np.sqrt(2)/Q['sigma']))), 
+    }
+    for tracer, (p_fast, p_exact) in probs.items():
+        assert np.allclose(p_fast, p_exact, rtol = 0, atol = 1e-6), tracer
+        N_fast, N_exact = np.sum(randoms < p_fast), np.sum(randoms < p_exact)
+        assert abs(N_fast - N_exact) <= 1e-4*N_exact + 2, tracer
+
+    # expected number of LRG satellites
+    n_fast = np.vectorize(n_sat_LRG_modified)(M, logM, L['logM_cut'], M_cut, M_1, L['sigma'], 
+        L['alpha'], L['kappa'])
+    n_exact = np.where(M > L['kappa']*M_cut, (np.maximum(M - L['kappa']*M_cut, 0)/M_1)**L['alpha'], 0)\
+        *0.5*erfc((L['logM_cut'] - logM)/(np.sqrt(2)*L['sigma']))
+    assert np.isclose(np.sum(n_fast), np.sum(n_exact), rtol = 1e-5, atol = 0)
+
+def selected_indices(gidx, kstart, counts, t):
+    '''Indices kept for tracer ``t`` by gen_cent/gen_sats, in block order
+    '''
+    from abacusnbody.hod.GRAND_HOD import BLOCK_SIZE
+    return np.concatenate([b*BLOCK_SIZE + gidx[kstart[b, t]: kstart[b, t] + counts[b, t]].astype(np.int64)
+        for b in range(len(counts))])
+
+def test_gen_sats_negative_decorator():
+    '''Test that a particle goes to the first tracer whose cumulative marker reaches its random,
+    also when a negative decorator makes the markers non-monotone
+    '''
+    import numba
+    from abacusnbody.hod.GRAND_HOD import gen_sats, n_sat_LRG_modified, N_sat_generic
+
+    with open(EXAMPLE_CONFIG) as f:
+        HOD_params = yaml.safe_load(f)['HOD_params']
+    L, E, Q = HOD_params['LRG_params'], HOD_params['ELG_params'], HOD_params['QSO_params']
+    L.update(s = 0.1)
+    E.update(s = 1., s_v = 1., s_p = 0.5, s_r = 0.5)
+
+    # a catalog of particles with ranks in [-1, 1], for which the ELG decorator goes negative
+    rng = np.random.default_rng(301)
+    Nparts = 100000
+    logM = rng.uniform(12., 15., Nparts)
+    M = 10**logM
+    weights = rng.uniform(0.01, 0.3, Nparts)
+    randoms = rng.random(Nparts)
+    zeros = np.zeros(Nparts)
+    ranks, ranksv, ranksp, ranksr = rng.uniform(-1., 1., (4, Nparts))
+
+    LRG_design = np.array([L['logM_cut'], L['logM1'], L['sigma'], L['alpha'], L['kappa']])
+    LRG_decorations = np.array([L[k] for k in ('alpha_c', 'alpha_s', 's', 's_v', 's_p', 's_r',
+        'Acent', 'Asat', 'Bcent', 'Bsat', 'ic')], dtype = float)
+    ELG_design = np.array([E[k] for k in ('p_max', 'Q', 'logM_cut', 'kappa', 'sigma', 'logM1',
+        'alpha', 'gamma', 'A_s')])
+    ELG_decorations = np.array([E[k] for k in ('alpha_c', 'alpha_s', 's', 's_v', 's_p', 's_r',
+        'Acent', 'Asat', 'Bcent', 'Bsat')], dtype = float)
+    QSO_design = np.array([Q[k] for k in ('p_max', 'logM_cut', 'kappa', 'sigma', 'logM1',
+        'alpha', 'A_s')])
+    QSO_decorations = np.array([Q[k] for k in ('alpha_c', 'alpha_s', 's', 's_v', 's_p', 's_r',
+        'Acent', 'Asat', 'Bcent', 'Bsat')], dtype = float)
+
+    gidx, kstart, counts = gen_sats(M, logM, weights, randoms, zeros, zeros,
+        True, ranks, ranksv, ranksp, ranksr,
+        LRG_design, LRG_decorations, ELG_design, ELG_decorations, QSO_design, QSO_decorations,
+        1e10, True, True, True, numba.config.NUMBA_NUM_THREADS)
+
+    # reference tags from the first-match cascade over the cumulative markers
+    exp_L = np.vectorize(n_sat_LRG_modified)(M, logM, L['logM_cut'], 10**L['logM_cut'],
+        10**L['logM1'], L['sigma'], L['alpha'], L['kappa'])*weights*L['ic']\
+        *(1 + L['s']*ranks + L['s_v']*ranksv + L['s_p']*ranksp + L['s_r']*ranksr)
+    exp_E = np.vectorize(N_sat_generic)(M, 10**E['logM_cut'], E['kappa'], 10**E['logM1'],
+        E['alpha'], E['A_s'])*weights\
+        *(1 + E['s']*ranks + E['s_v']*ranksv + E['s_p']*ranksp + E['s_r']*ranksr)
+    exp_Q = np.vectorize(N_sat_generic)(M, 10**Q['logM_cut'], Q['kappa'], 10**Q['logM1'],
+        Q['alpha'], Q['A_s'])*weights
+    assert np.any(exp_E < 0)
+    LRG_marker = exp_L
+    ELG_marker = LRG_marker + exp_E
+    QSO_marker = ELG_marker + exp_Q
+    tags = np.select([randoms <= LRG_marker, randoms <= ELG_marker, randoms <= QSO_marker], [1, 2, 3], 0)
+
+    for t in range(3):
+        assert np.array_equal(selected_indices(gidx, kstart, counts, t), np.flatnonzero(tags == t + 1))
+
+def test_rank_in_groups():
+    '''Test the one-sort ranks of prepare_sim against a per-group ``argsort().argsort()``,
+    with ties ranked in order of appearance
+    '''
+    from abacusnbody.hod.prepare_sim import rank_in_groups, rank_in_bins, rank_in_halos
+
+    # few distinct values, so that most groups hold ties, and some empty groups
+    rng = np.random.default_rng(303)
+    N, Ngroup = 3000, 60
+    values = rng.integers(0, 6, N).astype(float)
+    group = rng.integers(0, Ngroup - 5, N)
+    group[:3] = Ngroup - 1 # a group with few members
+
+    ranks, n = rank_in_groups(values, group, Ngroup)
+    for g in range(Ngroup):
+        m = group == g
+        assert np.array_equal(ranks[m], values[m].argsort(kind = 'stable').argsort())
+        assert np.all(n[m] == np.sum(m))
+
+    # mass bins from np.digitize as in prepare_slab, halos outside the bins (bin -1 and
+    # nbins) and lone halos rank 0
+    nbins = 20
+    bin_id = np.clip(group - 3, -1, nbins)
+    bin_id[bin_id == 5] = -1
+    bin_id[-1] = 5 # a lone halo
+    ref = np.zeros(N)
+    for ibin in range(nbins):
+        m = bin_id == ibin
+        if np.sum(m) > 1:
+            r = values[m].argsort(kind = 'stable').argsort()
+            ref[m] = r / np.max(r) - 0.5
+    assert np.array_equal(rank_in_bins(values, bin_id, nbins), ref)
+
+    # particle ranks within halos, lone particles rank 0
+    ref = np.zeros(N)
+    for g in range(Ngroup):
+        m = group == g
+        if np.sum(m) > 1:
+            r = values[m].argsort(kind = 'stable').argsort()
+            ref[m] = (r - np.mean(r)) / np.mean(r)
+    assert np.allclose(rank_in_halos(values, group, Ngroup), ref, rtol = 1e-6, atol = 1e-6)
+
+def test_perihelion_rp2():
+    '''Test the perihelion kernel of prepare_sim against the vectorized fixed-point iteration
+    '''
+    from abacusnbody.hod.prepare_sim import perihelion_rp2
+
+    rng = np.random.default_rng(304)
+    N = 5000
+    r0_kpc = rng.uniform(1., 1000., N)
+    rs = rng.uniform(0.02, 0.3, N)
+    c = rng.uniform(2., 10., N)
+    m = 10**rng.uniform(11., 15., N)
+    alpha = 1.0/(np.log(1+c)-c/(1+c))*2*6.67e-11*m*2e30/r0_kpc/3.086e+19/1e6
+    vel_rad = rng.normal(0., 300., N)
+    v_rad2 = vel_rad**2
+    v_tan2 = rng.normal(0., 300., N)**2
+    # particles at rest, where the iteration breaks down
+    v_rad2[:10] = 0
+    v_tan2[:10] = 0
+
+    num_iters = 20
+    factorA = v_tan2 + v_rad2
+    factorB = np.log(1+r0_kpc/rs)
+    with np.errstate(invalid = 'ignore'):
+        x2 = v_tan2/(v_tan2+v_rad2)
+        for it in range(num_iters):
+            oldx = np.sqrt(x2)
+            x2 = v_tan2/(factorA + alpha*(np.log(1+oldx*r0_kpc/rs)/oldx - factorB))
+    x2[np.isnan(x2)] = 1
+    rp2 = r0_kpc**2*x2
+
+    assert np.allclose(perihelion_rp2(v_tan2, v_rad2, alpha, r0_kpc, rs), rp2, rtol = 1e-10, atol = 0)
+
+def load_hod(tmp_path, **sim_params):
+    '''AbacusHOD object on the stored reference subsamples, with extra simulation parameters
+    '''
+    from abacusnbody.hod.abacus_hod import AbacusHOD
+
+    with open(EXAMPLE_CONFIG) as f:
+        config = yaml.safe_load(f)
+    config['sim_params'].update(sim_dir = os.path.dirname(__file__), 
+        subsample_dir = os.path.join(os.path.dirname(__file__), 'data_summit'), 
+        scratch_dir = str(tmp_path), **sim_params)
+    return AbacusHOD(config['sim_params'], config['HOD_params'], config['clustering_params'])
+
+def test_hod_rng_seed(tmp_path):
+    '''Test that a seeded HOD run is reproducible and leaves the staged draws untouched
+    '''
+    newBall = load_hod(tmp_path)
+    staged = {'hrandoms': newBall.halo_data['hrandoms'].copy(), 
+        'hveldev': newBall.halo_data['hveldev'].copy(), 
+        'prandoms': newBall.particle_data['prandoms'].copy()}
+    stored = newBall.run_hod(newBall.tracers, Nthread = 2)['LRG']
+
+    mock1 = newBall.run_hod(newBall.tracers, Nthread = 2, rng_seed = 42)['LRG']
+    mock2 = newBall.run_hod(newBall.tracers, Nthread = 2, rng_seed = 42)['LRG']
+    mock3 = newBall.run_hod(newBall.tracers, Nthread = 2, rng_seed = 43)['LRG']
+    for key in mock1:
+        assert np.array_equal(mock1[key], mock2[key]), key
+    assert len(mock1['id']) != len(mock3['id']) or not np.array_equal(mock1['id'], mock3['id'])
+
+    # the seeded runs redraw into new arrays, the runs on the stored draws are unchanged
+    assert np.array_equal(newBall.halo_data['hrandoms'], staged['hrandoms'])
+    assert np.array_equal(newBall.halo_data['hveldev'], staged['hveldev'])
+    assert np.array_equal(newBall.particle_data['prandoms'], staged['prandoms'])
+    again = newBall.run_hod(newBall.tracers, Nthread = 2)['LRG']
+    for key in stored:
+        assert np.array_equal(stored[key], again[key]), key
+
+def test_hod_float32(tmp_path):
+    '''Test that the float32 staging gives single precision galaxies and the same selection
+    '''
+    mock64 = load_hod(tmp_path)
+    mock64 = mock64.run_hod(mock64.tracers, Nthread = 2)['LRG']
+    mock32 = load_hod(tmp_path, want_float32 = True)
+    mock32 = mock32.run_hod(mock32.tracers, Nthread = 2)['LRG']
+
+    for key in ('x', 'y', 'z', 'vx', 'vy', 'vz'):
+        assert mock32[key].dtype == np.float32, key
+        assert np.allclose(mock32[key], mock64[key], rtol = 1e-5, atol = 1e-4), key
+    assert mock32['mass'].dtype == np.float64
+    assert mock32['id'].dtype == np.int64
+    assert mock32['Ncent'] == mock64['Ncent']
+    assert np.array_equal(mock32['id'], mock64['id'])
+    assert np.array_equal(mock32['mass'], mock64['mass'])
+
 if __name__ == '__main__':
     test_hod(".", reference_mode = True)
\ No newline at end of file